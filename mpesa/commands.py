@@ -0,0 +1,63 @@
+import json
+
+import click
+import frappe
+from frappe.commands import get_site, pass_context
+
+
+@click.command("mpesa-export-callbacks")
+@click.argument("output")
+@click.option("--clear", is_flag=True, default=False, help="Clear captured callbacks after export")
+@pass_context
+def export_callbacks(context, output, clear=False):
+	"""Export captured M-Pesa callbacks to a gzipped JSON lines file"""
+	from mpesa.mpesa.callback_capture import export_captures
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		count = export_captures(output, clear=clear)
+		click.echo(f"Exported {count} callbacks to {output}")
+	finally:
+		frappe.destroy()
+
+
+@click.command("mpesa-replay-callbacks")
+@click.argument("capture_file")
+@click.option("--url", help="Post callbacks to this URL, e.g. .../api/method/mpesa.mpesa.api.handle_callback."
+			  " Applied in-process when omitted. HTTP replays go through the callback pre-filter:"
+			  " the replaying host must pass the IP allowlist and stay under the callback rate limit"
+			  " (120 per minute by default), or requests are reported as rejected.")
+@click.option("--rate", type=float, default=0, help="Callbacks per second, 0 for as fast as possible")
+@click.option("--concurrency", type=int, default=1, help="Number of concurrent senders")
+@click.option("--duplicate-rate", type=float, default=0.0,
+			  help="Fraction of callbacks delivered twice (0 to 1)")
+@click.option("--shuffle", is_flag=True, default=False, help="Deliver callbacks out of order")
+@click.option("--seed", type=int, help="Random seed for duplicates and shuffling")
+@click.option("--restore-payments", is_flag=True, default=False,
+			  help="Reset or recreate the exported Mpesa Payments to their pre-callback state first")
+@pass_context
+def replay_callbacks(context, capture_file, url=None, rate=0, concurrency=1, duplicate_rate=0.0,
+					 shuffle=False, seed=None, restore_payments=False):
+	"""Replay captured M-Pesa callbacks and report throughput, latency and final statuses"""
+	from mpesa.mpesa.callback_capture import load_captures, replay_captures
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		captures, payments = load_captures(capture_file)
+		report = replay_captures(captures, site, url=url, rate=rate, concurrency=concurrency,
+								 duplicate_rate=duplicate_rate, shuffle=shuffle, seed=seed,
+								 payments=payments if restore_payments else None)
+		click.echo(json.dumps(report, indent=2))
+
+		correctness = report["correctness"]
+		if correctness["mismatched"] or correctness["missing"]:
+			raise SystemExit(1)
+	finally:
+		frappe.destroy()
+
+
+commands = [export_callbacks, replay_callbacks]
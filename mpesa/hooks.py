@@ -149,6 +149,18 @@ doctype_js = {
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+	"cron": {
+		"*/5 * * * *": [
+			"mpesa.mpesa.api.refresh_access_token",
+			"mpesa.mpesa.doctype.mpesa_payment.mpesa_payment.expire_abandoned_payments"
+		],
+	},
+	"daily": [
+		"mpesa.mpesa.rollup.reconcile_recent_rollups"
+	],
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"mpesa.tasks.all"
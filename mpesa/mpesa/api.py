@@ -4,7 +4,28 @@ import json
 from requests.auth import HTTPBasicAuth
 from datetime import datetime, timedelta
 import base64
-from frappe.utils import get_datetime
+import random
+from frappe.desk.form.save import send_updated_docs, set_local_name
+from frappe.utils import flt, get_datetime
+from frappe.utils.user import get_users_with_role
+
+from mpesa.mpesa.callback_capture import capture_callback
+from mpesa.mpesa.callback_filter import (get_rejection_counts, is_valid_c2b_payload,
+										  prefilter_callback, record_rejection)
+from mpesa.mpesa.doctype.mpesa_payment.mpesa_payment import (is_valid_status_transition,
+															 validate_status_transition)
+from mpesa.mpesa.rollup import rebuild_rollups, record_status_transition
+from mpesa.mpesa.throttle import acquire_stk_slot, release_stk_slot, stk_busy_response
+
+
+# Background refresh starts this long (plus jitter) before the stored expiry
+TOKEN_REFRESH_WINDOW = 15 * 60
+TOKEN_REFRESH_JITTER = 10 * 60
+TOKEN_REFRESH_FAILED_KEY = "mpesa:token_refresh_failed"
+
+# Columns the callback and resend paths need; full documents are never loaded there
+PAYMENT_STATE_FIELDS = ["name", "status", "amount", "creation", "company", "shortcode",
+						"pos_invoice", "sales_invoice", "receipt_number", "phone_number"]
 
 
 @frappe.whitelist()
@@ -66,6 +87,13 @@ def get_access_token():
 			frappe.log_error(f"Failed to convert token_expiry to datetime: {e}",
 							 "M-Pesa Token Error")
 
+	# refresh_access_token normally renews the token well before expiry, so an inline
+	# fetch here only happens when the background job has not run or has failed
+	return _fetch_access_token(settings)
+
+
+def _fetch_access_token(settings):
+	"""Request a new OAuth token from Daraja and store it on Mpesa Settings"""
 	# Determine auth URL based on mode
 	auth_url = ('https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'
 				if settings.live_test_mode == 'Test'
@@ -153,10 +181,58 @@ def get_access_token():
 		frappe.throw(error_msg)
 
 
+def refresh_access_token():
+	"""Scheduled job: renew the OAuth token ahead of expiry.
+
+	Runs every few minutes and refreshes once the token is inside a jittered window
+	before expiry, so checkout requests never wait on the OAuth round trip.
+	"""
+	settings = frappe.get_single("Mpesa Settings")
+	if not settings.consumer_key or not settings.shortcode:
+		return
+
+	refresh_window = timedelta(
+		seconds=TOKEN_REFRESH_WINDOW + random.randint(0, TOKEN_REFRESH_JITTER))
+	if settings.access_token and settings.token_expiry:
+		if get_datetime(settings.token_expiry) - datetime.now() > refresh_window:
+			return
+
+	cache = frappe.cache()
+	try:
+		_fetch_access_token(settings)
+	except Exception as e:
+		frappe.db.rollback()
+		# Alert once per failure streak; the job keeps retrying on every run
+		if not cache.get_value(TOKEN_REFRESH_FAILED_KEY):
+			cache.set_value(TOKEN_REFRESH_FAILED_KEY, 1)
+			notify_token_refresh_failure(str(e))
+		return
+
+	cache.delete_value(TOKEN_REFRESH_FAILED_KEY)
+	frappe.db.commit()
+
+
+def notify_token_refresh_failure(error):
+	frappe.log_error(f"Background M-Pesa token refresh failed: {error[:500]}",
+					 "M-Pesa Token Refresh Error")
+
+	for user in get_users_with_role("System Manager"):
+		frappe.get_doc({
+			"doctype": "Notification Log",
+			"for_user": user,
+			"type": "Alert",
+			"document_type": "Mpesa Settings",
+			"document_name": "Mpesa Settings",
+			"subject": "M-Pesa access token refresh failed. Checkout will fall back to inline token requests.",
+			"email_content": error[:500]
+		}).insert(ignore_permissions=True)
+	frappe.db.commit()
+
+
 @frappe.whitelist()
 def initiate_stk_push(phone_number, amount, pos_invoice_name=None, sales_invoice_name=None):
 	"""Initiate M-Pesa STK Push - supports both POS Invoice and Sales Invoice"""
-	settings = frappe.get_single("Mpesa Settings")
+	settings = frappe.get_cached_doc("Mpesa Settings")
 
 	# Determine which invoice type we're working with
 	invoice_name = pos_invoice_name or sales_invoice_name
@@ -165,17 +241,73 @@ def initiate_stk_push(phone_number, amount, pos_invoice_name=None, sales_invoice
 	if not invoice_name:
 		frappe.throw("Either pos_invoice_name or sales_invoice_name must be provided")
 
-	# CRITICAL: Verify Invoice exists with proper error handling
-	try:
-		invoice_doc = frappe.get_doc(invoice_doctype, invoice_name)
-	except frappe.DoesNotExistError:
+	# CRITICAL: Verify Invoice exists; only the columns the push needs are read
+	fields = ["name", "company"]
+	if invoice_doctype == "POS Invoice":
+		fields.append("pos_profile")
+
+	invoice = frappe.db.get_value(invoice_doctype, invoice_name, fields, as_dict=True)
+	if not invoice:
 		frappe.throw(
 			f"{invoice_doctype} {invoice_name} does not exist. Please save the invoice first and try again.")
+
+	return _initiate_for_invoice(settings, phone_number, amount, invoice_doctype, invoice)
+
+
+@frappe.whitelist()
+def save_and_pay(doc, phone_number, amount):
+	"""Save a draft POS Invoice and initiate the STK Push in a single request"""
+	invoice_doc = frappe.get_doc(frappe.parse_json(doc))
+
+	if invoice_doc.doctype != "POS Invoice":
+		frappe.throw("Only POS Invoices can be saved and paid in one step.")
+	if invoice_doc.docstatus != 0:
+		frappe.throw(f"POS Invoice {invoice_doc.name} is already submitted.")
+
+	# Same as savedocs, so the client can swap its local name for the real one
+	set_local_name(invoice_doc)
+	invoice_doc.save()
+	send_updated_docs(invoice_doc)
+
+	settings = frappe.get_single("Mpesa Settings")
+	try:
+		stk_response = _initiate_for_invoice(settings, phone_number, amount, "POS Invoice", invoice_doc)
 	except Exception as e:
-		frappe.log_error(f"Error validating {invoice_doctype} {invoice_name}: {str(e)}",
-						 "M-Pesa Invoice Validation")
-		frappe.throw(f"Unable to validate {invoice_doctype} {invoice_name}. Error: {str(e)[:100]}")
+		# The invoice is already saved, so report the STK failure in the response and
+		# let the client offer retry or cash instead of failing the whole request
+		frappe.clear_last_message()
+		return {
+			"pos_invoice": invoice_doc.name,
+			"error": str(e)
+		}
+
+	return {
+		"pos_invoice": invoice_doc.name,
+		"checkout_request_id": stk_response.get("CheckoutRequestID"),
+		"stk_response": stk_response
+	}
 
+
+def _initiate_for_invoice(settings, phone_number, amount, invoice_doctype, invoice):
+	"""Reserve an in-flight slot and send the STK Push for an already validated invoice.
+
+	`invoice` only needs `name`, `company` and, for POS Invoices, `pos_profile`.
+	"""
+	# Shed load early when the till or shortcode already has too many pushes in flight
+	pos_profile = invoice.get("pos_profile") if invoice_doctype == "POS Invoice" else None
+	lease = acquire_stk_slot(settings, pos_profile)
+	if not lease:
+		return stk_busy_response()
+
+	try:
+		return _send_stk_push(settings, phone_number, amount, invoice_doctype, invoice.name,
+							  invoice.company)
+	finally:
+		release_stk_slot(lease)
+
+
+def _send_stk_push(settings, phone_number, amount, invoice_doctype, invoice_name, company=None):
+	"""Record the Mpesa Payment and send the STK Push request to Daraja"""
 	# Get M-Pesa access token
 	try:
 		token = get_access_token()
@@ -229,6 +361,8 @@ def initiate_stk_push(phone_number, amount, pos_invoice_name=None, sales_invoice
 
 		payment_doc.amount = amount
 		payment_doc.phone_number = phone_number
+		payment_doc.company = company
+		payment_doc.shortcode = settings.shortcode
 		payment_doc.status = "Initiated"
 		payment_doc.insert(ignore_permissions=True)
 		frappe.db.commit()
@@ -271,12 +405,18 @@ def initiate_stk_push(phone_number, amount, pos_invoice_name=None, sales_invoice
 		response_data = response.json()
 
 		# Update payment document with response
-		payment_doc.reload()
-		payment_doc.checkout_request_id = response_data.get("CheckoutRequestID")
-		payment_doc.merchant_request_id = response_data.get("MerchantRequestID")
-		payment_doc.result_code = response_data.get("ResponseCode")
-		payment_doc.result_desc = response_data.get("ResponseDescription")
-		payment_doc.save(ignore_permissions=True)
+		payment = frappe.db.get_value("Mpesa Payment", payment_doc.name, PAYMENT_STATE_FIELDS,
+									  as_dict=True, for_update=True)
+		updates = {
+			"checkout_request_id": response_data.get("CheckoutRequestID"),
+			"merchant_request_id": response_data.get("MerchantRequestID"),
+			"result_code": response_data.get("ResponseCode"),
+			"result_desc": response_data.get("ResponseDescription")
+		}
+		# Daraja accepted the request; only move forward if no callback has landed yet
+		if response_data.get("ResponseCode") == "0" and payment.status == "Initiated":
+			updates["status"] = "Pending"
+		update_payment_state(payment, updates)
 		frappe.db.commit()
 
 		return response_data
@@ -294,120 +434,184 @@ def initiate_stk_push(phone_number, amount, pos_invoice_name=None, sales_invoice
 @frappe.whitelist(allow_guest=True)
 def handle_callback():
 	"""Enhanced M-Pesa payment callback handler"""
-	if frappe.request.method != "POST":
-		frappe.log_error("Invalid callback method", "M-Pesa Callback")
-		return {"status": "error", "message": "Invalid method"}
+	# Reject junk before any DB access; rejections are only counted, never logged
+	data = prefilter_callback()
+	if data is None:
+		return {"status": "error", "message": "Rejected"}
+
+	capture_callback("stk", data)
 
 	try:
-		# Parse callback data
-		raw_data = frappe.request.data
-		frappe.logger().info(f"M-Pesa Callback Raw Data: {raw_data}")
+		frappe.logger().info(f"M-Pesa Callback Data: {data}")
+		return process_stk_callback(data.get("Body", {}).get("stkCallback", {}))
 
-		data = json.loads(raw_data)
-		callback_metadata = data.get("Body", {}).get("stkCallback", {})
+	except Exception as e:
+		frappe.log_error(f"Callback processing error: {str(e)}", "M-Pesa Callback Error")
+		return {"status": "error", "message": "Processing failed"}
 
-		result_code = callback_metadata.get("ResultCode")
-		checkout_request_id = callback_metadata.get("CheckoutRequestID")
-		merchant_request_id = callback_metadata.get("MerchantRequestID")
-		result_desc = callback_metadata.get("ResultDesc", "")
 
-		frappe.logger().info(
-			f"Callback - CheckoutRequestID: {checkout_request_id}, ResultCode: {result_code}")
+def process_stk_callback(callback_metadata):
+	"""Apply a parsed stkCallback body to its Mpesa Payment and commit"""
+	result_code = callback_metadata.get("ResultCode")
+	checkout_request_id = callback_metadata.get("CheckoutRequestID")
+	result_desc = callback_metadata.get("ResultDesc", "")
 
-		# Find Mpesa Payment record
-		payment_doc_name = frappe.get_value("Mpesa Payment",
-											{"checkout_request_id": checkout_request_id})
-		if not payment_doc_name:
-			frappe.log_error(f"Unknown CheckoutRequestID: {checkout_request_id}",
-							 "M-Pesa Callback")
-			return {"status": "error", "message": "Payment record not found"}
+	frappe.logger().info(
+		f"Callback - CheckoutRequestID: {checkout_request_id}, ResultCode: {result_code}")
 
-		payment_doc = frappe.get_doc("Mpesa Payment", payment_doc_name)
+	# Find Mpesa Payment record
+	payment = get_payment_state(checkout_request_id)
+	if not payment:
+		# Well-formed junk is easy to produce, so count it instead of writing Error Logs
+		record_rejection("unknown")
+		frappe.logger().info(f"Unknown CheckoutRequestID: {checkout_request_id}")
+		return {"status": "error", "message": "Payment record not found"}
 
-		# Always update basic callback info
-		payment_doc.result_code = str(result_code)
-		payment_doc.result_desc = result_desc
+	# Always update basic callback info
+	updates = {
+		"result_code": str(result_code),
+		"result_desc": result_desc
+	}
+	transaction_details = {}
 
-		if result_code == 0:
-			# Payment successful - extract transaction details
-			payment_doc.status = "Completed"
+	if result_code == 0:
+		# Payment successful - extract transaction details
+		updates["status"] = "Completed"
 
-			# Extract M-Pesa transaction details
-			callback_items = callback_metadata.get("CallbackMetadata", {}).get("Item", [])
-			transaction_details = {}
+		callback_items = callback_metadata.get("CallbackMetadata", {}).get("Item", [])
+		for item in callback_items:
+			name = item.get("Name", "")
+			value = item.get("Value")
+			transaction_details[name] = value
 
-			for item in callback_items:
-				name = item.get("Name", "")
-				value = item.get("Value")
-				transaction_details[name] = value
+			# Store key transaction details
+			if name == "MpesaReceiptNumber":
+				updates["receipt_number"] = value
+			elif name == "PhoneNumber":
+				updates["phone_number"] = str(value)
 
-				# Store key transaction details
-				if name == "MpesaReceiptNumber":
-					payment_doc.receipt_number = value
-				elif name == "TransactionDate":
-					payment_doc.transaction_date = value
-				elif name == "PhoneNumber":
-					payment_doc.phone_number = str(value)
+		frappe.logger().info(f"Transaction Details: {transaction_details}")
+	else:
+		# Payment failed
+		updates["status"] = "Failed"
+		frappe.logger().info(f"Payment failed - Code: {result_code}, Desc: {result_desc}")
 
-			frappe.logger().info(f"Transaction Details: {transaction_details}")
+	apply_payment_result(payment, updates, transaction_details)
 
-			# Handle payment entry creation based on invoice type
-			try:
-				create_payment_entries(payment_doc, transaction_details)
-			except Exception as pe:
-				frappe.log_error(f"Payment entry creation failed: {str(pe)}",
-								 "M-Pesa Payment Entry Error")
-		# Don't fail the callback, just log the error
+	frappe.logger().info(f"M-Pesa callback processed successfully for {payment.name}")
+	return {"status": "success", "message": "Callback processed"}
 
-		else:
-			# Payment failed
-			payment_doc.status = "Failed"
-			frappe.logger().info(f"Payment failed - Code: {result_code}, Desc: {result_desc}")
 
-		# Save payment document
-		payment_doc.save(ignore_permissions=True)
-		frappe.db.commit()
+@frappe.whitelist(allow_guest=True)
+def c2b_confirmation():
+	"""C2B confirmation handler, used to ingest Dynamic QR payments"""
+	data = prefilter_callback(validate=is_valid_c2b_payload)
+	if data is None:
+		return {"ResultCode": "C2B00016", "ResultDesc": "Rejected"}
 
-		frappe.logger().info(f"M-Pesa callback processed successfully for {payment_doc.name}")
-		return {"status": "success", "message": "Callback processed"}
+	capture_callback("c2b", data)
 
-	except json.JSONDecodeError as je:
-		frappe.log_error(f"Invalid JSON in callback: {str(je)}", "M-Pesa Callback JSON Error")
-		return {"status": "error", "message": "Invalid JSON"}
+	try:
+		process_c2b_confirmation(data)
 	except Exception as e:
-		frappe.log_error(f"Callback processing error: {str(e)}", "M-Pesa Callback Error")
-		return {"status": "error", "message": "Processing failed"}
-
+		frappe.log_error(f"C2B confirmation processing error: {str(e)}", "M-Pesa C2B Error")
+
+	# Daraja only needs an acknowledgement; the payment is already settled on its side
+	return {"ResultCode": 0, "ResultDesc": "Accepted"}
+
+
+def process_c2b_confirmation(data):
+	"""Match a C2B confirmation to the Initiated QR payment for its bill reference"""
+	reference = data.get("BillRefNumber")
+	amount = flt(data.get("TransAmount"))
+
+	payment = frappe.db.get_value(
+		"Mpesa Payment",
+		{"pos_invoice": reference, "channel": "Dynamic QR",
+		 "status": ["in", ["Initiated", "Pending", "Expired"]], "amount": amount},
+		PAYMENT_STATE_FIELDS, as_dict=True, order_by="creation desc", for_update=True)
+	if not payment:
+		if frappe.db.exists("Mpesa Payment", {"receipt_number": data.get("TransID")}):
+			frappe.logger().info(f"Duplicate C2B confirmation: {data.get('TransID')}")
+		elif frappe.db.exists("Mpesa Payment", {"pos_invoice": reference, "channel": "Dynamic QR"}):
+			# The customer paid a QR invoice but not the amount it asked for
+			frappe.log_error(f"C2B payment {data.get('TransID')} for {reference} has unexpected amount {amount}",
+							 "M-Pesa C2B")
+		else:
+			# Every ordinary paybill payment on the shortcode lands here, so only count it
+			record_rejection("unmatched")
+			frappe.logger().info(f"Unmatched C2B payment {data.get('TransID')} for {reference}: {amount}")
+		return
 
-def create_payment_entries(payment_doc, transaction_details):
-	"""Create appropriate payment entries based on invoice type"""
+	updates = {
+		"status": "Completed",
+		"result_code": "0",
+		"result_desc": data.get("TransactionType") or "C2B payment confirmed",
+		"receipt_number": data.get("TransID"),
+		"phone_number": str(data.get("MSISDN") or payment.phone_number or "")
+	}
+	apply_payment_result(payment, updates, data)
 
-	# Determine invoice type and get invoice document
-	if payment_doc.pos_invoice:
-		invoice_name = payment_doc.pos_invoice
-		invoice_doctype = "POS Invoice"
 
-		# For POS Invoice, we typically don't create Payment Entry immediately
-		# as POS Invoices are consolidated during POS closing
+def apply_payment_result(payment, updates, transaction_details=None):
+	"""Persist a callback outcome and create payment entries for completed payments"""
+	# Duplicate or out-of-order deliveries must not move a payment backwards
+	if not is_valid_status_transition(payment.status, updates.get("status", payment.status)):
 		frappe.logger().info(
-			f"POS Invoice payment completed: {invoice_name}, Receipt: {payment_doc.receipt_number}")
+			f"Ignoring {updates.get('status')} result for {payment.name} in status {payment.status}")
+		return
+
+	update_payment_state(payment, updates)
 
-		# Update POS Invoice with payment info if needed
+	if payment.status == "Completed":
+		# Handle payment entry creation based on invoice type
 		try:
-			pos_invoice = frappe.get_doc("POS Invoice", invoice_name)
-		# You might want to add custom fields to track M-Pesa details
-		# pos_invoice.mpesa_receipt_number = payment_doc.receipt_number
-		# pos_invoice.save(ignore_permissions=True)
-		except Exception as e:
-			frappe.log_error(f"Error updating POS Invoice: {str(e)}", "POS Invoice Update Error")
+			create_payment_entries(payment, transaction_details or {})
+		except Exception as pe:
+			# Don't fail the callback, just log the error
+			frappe.log_error(f"Payment entry creation failed: {str(pe)}",
+							 "M-Pesa Payment Entry Error")
+
+	frappe.db.commit()
+
+
+def get_payment_state(checkout_request_id):
+	"""Fetch only the Mpesa Payment columns needed to apply a status change.
+
+	The row is locked so concurrent callbacks for one payment apply in turn.
+	"""
+	if not checkout_request_id:
+		return None
+
+	return frappe.db.get_value("Mpesa Payment", {"checkout_request_id": checkout_request_id},
+							   PAYMENT_STATE_FIELDS, as_dict=True, for_update=True)
+
 
-	elif payment_doc.sales_invoice:
-		invoice_name = payment_doc.sales_invoice
-		invoice_doctype = "Sales Invoice"
+def update_payment_state(payment, updates):
+	"""Write columns on an Mpesa Payment without loading the document.
 
+	Keeps the collection rollups in step, since the controller hooks do not run.
+	"""
+	old_status = payment.status
+	validate_status_transition(old_status, updates.get("status", old_status))
+	frappe.db.set_value("Mpesa Payment", payment.name, updates)
+	payment.update(updates)
+	record_status_transition(payment, old_status, payment.status)
+
+
+def create_payment_entries(payment, transaction_details):
+	"""Create appropriate payment entries based on invoice type"""
+
+	if payment.pos_invoice:
+		# POS Invoices are consolidated during POS closing, so no Payment Entry is
+		# created here and the invoice itself does not need to be loaded
+		frappe.logger().info(
+			f"POS Invoice payment completed: {payment.pos_invoice}, Receipt: {payment.receipt_number}")
+
+	elif payment.sales_invoice:
 		# For Sales Invoice, create Payment Entry
 		try:
-			create_sales_invoice_payment_entry(payment_doc, transaction_details)
+			create_sales_invoice_payment_entry(payment, transaction_details)
 		except Exception as e:
 			frappe.log_error(f"Error creating Payment Entry: {str(e)}",
 							 "Payment Entry Creation Error")
@@ -428,7 +632,12 @@ def create_sales_invoice_payment_entry(payment_doc, transaction_details):
 		return
 
 	try:
-		sales_invoice = frappe.get_doc("Sales Invoice", payment_doc.sales_invoice)
+		sales_invoice = frappe.db.get_value(
+			"Sales Invoice", payment_doc.sales_invoice,
+			["name", "customer", "company", "due_date", "grand_total", "outstanding_amount"],
+			as_dict=True)
+		if not sales_invoice:
+			frappe.throw(f"Sales Invoice {payment_doc.sales_invoice} does not exist.")
 
 		# Get M-Pesa account - ensure this account exists in Chart of Accounts
 		mpesa_account = get_mpesa_account()
@@ -513,14 +722,13 @@ def get_mpesa_account():
 def get_payment_status(checkout_request_id):
 	"""Manual payment status check for troubleshooting"""
 	try:
-		payment_doc = frappe.get_doc("Mpesa Payment", {"checkout_request_id": checkout_request_id})
-		return {
-			"status": payment_doc.status,
-			"receipt_number": payment_doc.receipt_number,
-			"result_desc": payment_doc.result_desc,
-			"amount": payment_doc.amount,
-			"phone_number": payment_doc.phone_number
-		}
+		payment = frappe.db.get_value(
+			"Mpesa Payment", {"checkout_request_id": checkout_request_id},
+			["status", "receipt_number", "result_desc", "amount", "phone_number"],
+			as_dict=True)
+		if not payment:
+			return {"error": f"No Mpesa Payment found for CheckoutRequestID {checkout_request_id}"}
+		return payment
 	except Exception as e:
 		return {"error": str(e)}
 
@@ -529,27 +737,31 @@ def get_payment_status(checkout_request_id):
 def resend_stk_push(checkout_request_id):
 	"""Resend STK Push for failed payments"""
 	try:
-		payment_doc = frappe.get_doc("Mpesa Payment", {"checkout_request_id": checkout_request_id})
+		payment = get_payment_state(checkout_request_id)
+		if not payment:
+			return {"error": f"No Mpesa Payment found for CheckoutRequestID {checkout_request_id}"}
 
-		if payment_doc.status == "Completed":
+		if payment.status == "Completed":
 			return {"error": "Payment already completed"}
 
-		# Get original invoice
-		invoice_name = payment_doc.pos_invoice or payment_doc.sales_invoice
-		invoice_doctype = "POS Invoice" if payment_doc.pos_invoice else "Sales Invoice"
-
-		# Cancel old payment record
-		payment_doc.status = "Cancelled"
-		payment_doc.save(ignore_permissions=True)
-
 		# Create new STK Push
-		return initiate_stk_push(
-			payment_doc.phone_number,
-			payment_doc.amount,
-			pos_invoice_name=payment_doc.pos_invoice,
-			sales_invoice_name=payment_doc.sales_invoice
+		response = initiate_stk_push(
+			payment.phone_number,
+			payment.amount,
+			pos_invoice_name=payment.pos_invoice,
+			sales_invoice_name=payment.sales_invoice
 		)
 
+		# Cancel the old payment record only once its replacement was accepted, so a
+		# busy or failed resend leaves the original push untouched
+		if response.get("ResponseCode") == "0":
+			payment = get_payment_state(checkout_request_id)
+			if is_valid_status_transition(payment.status, "Cancelled"):
+				update_payment_state(payment, {"status": "Cancelled"})
+				frappe.db.commit()
+
+		return response
+
 	except Exception as e:
 		frappe.log_error(f"Resend STK Push error: {str(e)}", "M-Pesa Resend Error")
 		return {"error": str(e)}
@@ -558,38 +770,53 @@ def resend_stk_push(checkout_request_id):
 @frappe.whitelist(allow_guest=True)
 def mpesa_callback():
 	"""Simple M-Pesa callback handler"""
-	try:
-		if frappe.request.method != "POST":
-			return {"status": "error", "message": "Only POST allowed"}
+	data = prefilter_callback()
+	if data is None:
+		return {"status": "error", "message": "Rejected"}
 
-		data = json.loads(frappe.request.data)
-		callback_metadata = data.get("Body", {}).get("stkCallback", {})
+	capture_callback("stk", data)
 
+	try:
+		callback_metadata = data.get("Body", {}).get("stkCallback", {})
 		result_code = callback_metadata.get("ResultCode")
-		checkout_request_id = callback_metadata.get("CheckoutRequestID")
 
 		# Find payment record
-		payment_doc_name = frappe.get_value("Mpesa Payment",
-											{"checkout_request_id": checkout_request_id})
-		if not payment_doc_name:
+		payment = get_payment_state(callback_metadata.get("CheckoutRequestID"))
+		if not payment:
+			record_rejection("unknown")
 			return {"status": "error", "message": "Payment not found"}
 
-		payment_doc = frappe.get_doc("Mpesa Payment", payment_doc_name)
-
+		updates = {}
 		if result_code == 0:
-			payment_doc.status = "Completed"
+			updates["status"] = "Completed"
 			# Extract receipt number
 			for item in callback_metadata.get("CallbackMetadata", {}).get("Item", []):
 				if item.get("Name") == "MpesaReceiptNumber":
-					payment_doc.receipt_number = item.get("Value")
+					updates["receipt_number"] = item.get("Value")
 		else:
-			payment_doc.status = "Failed"
+			updates["status"] = "Failed"
 
-		payment_doc.save(ignore_permissions=True)
-		frappe.db.commit()
+		if is_valid_status_transition(payment.status, updates["status"]):
+			update_payment_state(payment, updates)
+			frappe.db.commit()
 
 		return {"status": "success"}
 
 	except Exception as e:
 		frappe.log_error(str(e), "M-Pesa Callback Error")
 		return {"status": "error", "message": str(e)}
+
+
+@frappe.whitelist()
+def get_callback_rejection_stats():
+	"""Counts of callback requests dropped by the pre-filter, keyed by reason"""
+	frappe.only_for("System Manager")
+	return get_rejection_counts()
+
+
+@frappe.whitelist()
+def rebuild_collection_rollups(from_date, to_date=None):
+	"""Recompute Mpesa Collection Rollup rows for a date range"""
+	frappe.only_for("System Manager")
+	rebuild_rollups(from_date, to_date)
+	return {"status": "success"}
@@ -0,0 +1,356 @@
+import copy
+import gzip
+import json
+import random
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+import requests
+from frappe.utils import cint, now_datetime
+
+from mpesa.mpesa.rollup import record_status_transition
+
+CAPTURE_KEY = "mpesa:callback_capture"
+DEFAULT_CAPTURE_LIMIT = 10000
+# Sent by HTTP replays so callbacks replayed against a capturing site are not captured again
+REPLAY_HEADER = "X-Mpesa-Replay"
+
+# Callback fields that identify the customer; masked before anything is stored
+REDACTED_ITEMS = {"PhoneNumber"}
+REDACTED_C2B_FIELDS = {"MSISDN", "FirstName", "MiddleName", "LastName"}
+
+# Mpesa Payment columns exported alongside captures so a replay has rows to match
+PAYMENT_ROW_FIELDS = ["name", "creation", "amount", "pos_invoice", "sales_invoice", "company",
+					  "shortcode", "channel", "checkout_request_id", "merchant_request_id"]
+# Restored payments that no longer exist get a placeholder, since captures hold masked numbers
+RESTORED_PHONE_NUMBER = "254700000000"
+
+
+def capture_callback(kind, data):
+	"""Store a redacted, compressed copy of an accepted callback when capture is on.
+
+	Captures go to a capped Redis list so recording adds no database writes.
+	"""
+	settings = frappe.get_cached_doc("Mpesa Settings")
+	if not settings.capture_callbacks or _is_replay():
+		return
+
+	try:
+		record = {"t": time.time(), "kind": kind, "body": redact_payload(kind, data)}
+		entry = zlib.compress(json.dumps(record, separators=(",", ":")).encode("utf-8"))
+
+		cache = frappe.cache()
+		limit = cint(settings.callback_capture_limit) or DEFAULT_CAPTURE_LIMIT
+		cache.rpush(CAPTURE_KEY, entry)
+		cache.ltrim(CAPTURE_KEY, -limit, -1)
+	except Exception:
+		# Capture is diagnostic only and must never break callback processing
+		frappe.logger().exception("Failed to capture M-Pesa callback")
+
+
+def _is_replay():
+	request = getattr(frappe.local, "request", None)
+	return bool(request and request.headers.get(REPLAY_HEADER))
+
+
+def redact_payload(kind, data):
+	data = copy.deepcopy(data)
+
+	if kind == "c2b":
+		for field in REDACTED_C2B_FIELDS & set(data):
+			data[field] = mask_value(data[field])
+		return data
+
+	callback = data.get("Body", {}).get("stkCallback", {})
+	for item in callback.get("CallbackMetadata", {}).get("Item", []):
+		if item.get("Name") in REDACTED_ITEMS:
+			item["Value"] = mask_value(item.get("Value"))
+	return data
+
+
+def mask_value(value):
+	value = str(value or "")
+	if len(value) <= 6:
+		return "*" * len(value)
+	return value[:4] + "*" * (len(value) - 7) + value[-3:]
+
+
+def export_captures(path, clear=False):
+	"""Write captured callbacks to a gzipped JSON lines file and return the count.
+
+	The Mpesa Payment rows the callbacks refer to are written after them as
+	`{"kind": "payment", "row": ...}` lines, so the replay site can be seeded.
+	"""
+	cache = frappe.cache()
+	entries = cache.lrange(CAPTURE_KEY, 0, -1)
+	captures = [json.loads(zlib.decompress(entry)) for entry in entries]
+
+	with gzip.open(path, "wt", encoding="utf-8") as f:
+		for record in captures:
+			f.write(json.dumps(record, separators=(",", ":")))
+			f.write("\n")
+		for row in get_payment_rows(captures):
+			f.write(json.dumps({"kind": "payment", "row": row}, separators=(",", ":"), default=str))
+			f.write("\n")
+
+	if clear:
+		cache.delete_value(CAPTURE_KEY)
+
+	return len(captures)
+
+
+def get_payment_rows(captures):
+	"""Mpesa Payment rows matched by the captured callbacks, without callback results"""
+	keys = {"stk": set(), "c2b": set()}
+	for capture in captures:
+		keys[capture["kind"]].add(get_capture_key(capture))
+
+	rows = {}
+	for kind, field in (("stk", "checkout_request_id"), ("c2b", "receipt_number")):
+		if not keys[kind]:
+			continue
+		for row in frappe.get_all("Mpesa Payment", filters={field: ["in", list(keys[kind])]},
+								  fields=PAYMENT_ROW_FIELDS):
+			rows[row.name] = row
+
+	return list(rows.values())
+
+
+def load_captures(path):
+	"""Return the captured callbacks and exported payment rows from an export file"""
+	opener = gzip.open if path.endswith(".gz") else open
+	captures, payments = [], []
+	with opener(path, "rt", encoding="utf-8") as f:
+		for line in f:
+			if not line.strip():
+				continue
+			record = json.loads(line)
+			if record["kind"] == "payment":
+				payments.append(record["row"])
+			else:
+				captures.append(record)
+	return captures, payments
+
+
+def restore_payments(rows):
+	"""Put exported payments back in the state they were in before their callbacks.
+
+	Existing rows are reset in place and keep their phone number; missing rows are
+	inserted. STK payments go back to Pending and Dynamic QR payments to Initiated.
+	"""
+	from mpesa.mpesa.api import PAYMENT_STATE_FIELDS
+
+	for row in rows:
+		status = "Initiated" if row.get("channel") == "Dynamic QR" else "Pending"
+		reset = {"status": status, "receipt_number": None, "result_code": None, "result_desc": None}
+
+		payment = frappe.db.get_value("Mpesa Payment", row["name"], PAYMENT_STATE_FIELDS,
+									  as_dict=True, for_update=True)
+		if payment:
+			frappe.db.set_value("Mpesa Payment", payment.name, reset, update_modified=False)
+			record_status_transition(payment, payment.status, status)
+			continue
+
+		payment = frappe.get_doc(dict(row, doctype="Mpesa Payment", phone_number=RESTORED_PHONE_NUMBER,
+									  **reset))
+		payment.modified = now_datetime()
+		payment.owner = payment.modified_by = frappe.session.user
+		payment.db_insert()
+		record_status_transition(payment, None, status)
+
+	frappe.db.commit()
+	return len(rows)
+
+
+def strip_redacted_fields(capture):
+	"""Drop masked identity fields so a replay never writes them over real values"""
+	capture = copy.deepcopy(capture)
+	body = capture["body"]
+
+	if capture["kind"] == "c2b":
+		for field in REDACTED_C2B_FIELDS:
+			body.pop(field, None)
+		return capture
+
+	metadata = body["Body"]["stkCallback"].get("CallbackMetadata")
+	if metadata and "Item" in metadata:
+		metadata["Item"] = [item for item in metadata["Item"] if item.get("Name") not in REDACTED_ITEMS]
+	return capture
+
+
+def get_capture_key(capture):
+	"""Identifier the final Mpesa Payment state is checked against"""
+	if capture["kind"] == "c2b":
+		return capture["body"].get("TransID")
+	return capture["body"]["Body"]["stkCallback"].get("CheckoutRequestID")
+
+
+def get_expected_statuses(captures):
+	"""Final status per payment implied by the captures in their original order"""
+	expected = {"stk": {}, "c2b": {}}
+	for capture in captures:
+		if capture["kind"] == "c2b":
+			status = "Completed"
+		else:
+			result_code = capture["body"]["Body"]["stkCallback"].get("ResultCode")
+			status = "Completed" if result_code == 0 else "Failed"
+		expected[capture["kind"]][get_capture_key(capture)] = status
+	return expected
+
+
+def build_schedule(captures, duplicate_rate=0.0, shuffle=False, seed=None):
+	"""Order captures for replay, optionally duplicating and shuffling deliveries"""
+	rng = random.Random(seed)
+	schedule = []
+	for capture in captures:
+		schedule.append(capture)
+		if duplicate_rate and rng.random() < duplicate_rate:
+			schedule.append(capture)
+
+	if shuffle:
+		rng.shuffle(schedule)
+
+	return schedule
+
+
+def replay_captures(captures, site, url=None, rate=0, concurrency=1, duplicate_rate=0.0,
+					shuffle=False, seed=None, payments=None):
+	"""Replay captured callbacks and report throughput, latency and final-state correctness.
+
+	With `url` each callback is posted over HTTP (e.g. to `handle_callback`);
+	otherwise it is applied in-process through the same ingestion functions.
+	`payments` are exported payment rows to restore before replaying.
+
+	HTTP replays pass through the callback pre-filter, so they are subject to its
+	allowlist and per-source rate limit. Requests it turns away are reported as
+	`rejected`, separately from processing `errors`.
+	"""
+	restored = restore_payments(payments) if payments else 0
+	schedule = build_schedule([strip_redacted_fields(capture) for capture in captures],
+							  duplicate_rate, shuffle, seed)
+
+	if url:
+		send = _make_http_sender(url)
+		initializer, initargs = None, ()
+	else:
+		send = _send_direct
+		initializer, initargs = _init_replay_thread, (site,)
+
+	started = time.monotonic()
+	with ThreadPoolExecutor(max_workers=max(cint(concurrency), 1), initializer=initializer,
+							initargs=initargs) as pool:
+		futures = []
+		for i, capture in enumerate(schedule):
+			if rate:
+				delay = started + i / rate - time.monotonic()
+				if delay > 0:
+					time.sleep(delay)
+			futures.append(pool.submit(_timed, send, capture))
+		results = [future.result() for future in futures]
+	elapsed = time.monotonic() - started
+
+	latencies = sorted(latency for latency, _outcome in results)
+	rejected = sum(1 for _latency, outcome in results if outcome == "rejected")
+	errors = sum(1 for _latency, outcome in results if outcome == "error")
+
+	return {
+		"sent": len(schedule),
+		"unique": len(captures),
+		"duplicates": len(schedule) - len(captures),
+		"restored": restored,
+		"rejected": rejected,
+		"errors": errors,
+		"elapsed": round(elapsed, 3),
+		"throughput": round(len(schedule) / elapsed, 2) if elapsed else 0,
+		"latency_ms": {
+			"p50": _percentile(latencies, 50),
+			"p95": _percentile(latencies, 95),
+			"p99": _percentile(latencies, 99),
+			"max": _percentile(latencies, 100),
+		},
+		"correctness": check_final_states(get_expected_statuses(captures)),
+	}
+
+
+def check_final_states(expected):
+	"""Compare Mpesa Payment statuses in the database with the expected outcomes"""
+	actual = {}
+	if expected["stk"]:
+		for row in frappe.get_all("Mpesa Payment",
+								  filters={"checkout_request_id": ["in", list(expected["stk"])]},
+								  fields=["checkout_request_id", "status"]):
+			actual[row.checkout_request_id] = row.status
+	if expected["c2b"]:
+		for row in frappe.get_all("Mpesa Payment",
+								  filters={"receipt_number": ["in", list(expected["c2b"])]},
+								  fields=["receipt_number", "status"]):
+			actual[row.receipt_number] = row.status
+
+	matched, mismatched, missing = 0, [], []
+	for kind in ("stk", "c2b"):
+		for key, status in expected[kind].items():
+			if key not in actual:
+				missing.append(key)
+			elif actual[key] == status:
+				matched += 1
+			else:
+				mismatched.append({"id": key, "expected": status, "actual": actual[key]})
+
+	return {"matched": matched, "mismatched": mismatched, "missing": missing}
+
+
+def _timed(send, capture):
+	"""Send one capture and return its latency and outcome: ok, rejected or error"""
+	started = time.monotonic()
+	try:
+		outcome = send(capture)
+	except Exception:
+		outcome = "error"
+	return (time.monotonic() - started) * 1000, outcome
+
+
+def _make_http_sender(url):
+	session = requests.Session()
+	session.headers[REPLAY_HEADER] = "1"
+
+	def send(capture):
+		response = session.post(url, json=capture["body"], timeout=30)
+		if response.status_code != 200:
+			return "error"
+		message = response.json().get("message") or {}
+		if "Rejected" in (message.get("message"), message.get("ResultDesc")):
+			return "rejected"
+		if message.get("status") == "success" or message.get("ResultCode") == 0:
+			return "ok"
+		return "error"
+
+	return send
+
+
+def _init_replay_thread(site):
+	frappe.init(site=site)
+	frappe.connect()
+
+
+def _send_direct(capture):
+	from mpesa.mpesa.api import process_c2b_confirmation, process_stk_callback
+
+	try:
+		if capture["kind"] == "c2b":
+			process_c2b_confirmation(capture["body"])
+			return "ok"
+
+		response = process_stk_callback(capture["body"]["Body"]["stkCallback"])
+		return "ok" if response["status"] == "success" else "error"
+	except Exception:
+		frappe.db.rollback()
+		raise
+
+
+def _percentile(values, percent):
+	if not values:
+		return 0
+	index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+	return round(values[index], 2)
@@ -0,0 +1,179 @@
+import ipaddress
+import json
+import time
+
+import frappe
+from frappe.utils import cint
+from frappe.utils.redis_wrapper import RedisWrapper
+
+REJECTION_COUNTER_KEY = "mpesa:callback_rejections"
+RATE_LIMIT_WINDOW = 60
+DEFAULT_RATE_LIMIT = 120
+DEFAULT_ALLOWLISTED_RATE_LIMIT = 1200
+DEFAULT_MAX_BODY_BYTES = 16384
+
+
+def prefilter_callback(validate=None):
+	"""Validate an inbound Daraja callback before it touches the database.
+
+	Checks the request method, source IP allowlist, per-source rate limit, body size
+	and payload shape (`validate`, STK callback shape by default). Returns the parsed
+	payload, or None when the request is rejected. Rejections only bump a Redis
+	counter so junk traffic against the guest endpoints never produces Error Log rows.
+	"""
+	if frappe.request.method != "POST":
+		return _reject("method")
+
+	settings = frappe.get_cached_doc("Mpesa Settings")
+	source_ip = get_source_ip(frappe.request, cint(settings.callback_trusted_proxies))
+
+	if not _ip_allowed(source_ip, settings.callback_allowed_ips):
+		return _reject("ip")
+
+	# Daraja posts from a few allowlisted IPs and never re-delivers STK callbacks, so
+	# those sources get a much higher limit instead of the per-client one
+	if _parse_allowlist(settings.callback_allowed_ips):
+		limit = cint(settings.callback_allowlisted_rate_limit) or DEFAULT_ALLOWLISTED_RATE_LIMIT
+	else:
+		limit = settings.callback_rate_limit
+	if _rate_limited(source_ip, limit):
+		return _reject("rate")
+
+	max_body_bytes = cint(settings.callback_max_body_bytes) or DEFAULT_MAX_BODY_BYTES
+	if cint(frappe.request.content_length) > max_body_bytes:
+		return _reject("size")
+
+	raw_data = frappe.request.get_data(cache=True)
+	if not raw_data or len(raw_data) > max_body_bytes:
+		return _reject("size")
+
+	try:
+		data = json.loads(raw_data)
+	except ValueError:
+		return _reject("json")
+
+	if not (validate or is_valid_callback_payload)(data):
+		return _reject("shape")
+
+	return data
+
+
+def is_valid_callback_payload(data):
+	"""Return True if `data` looks like an STK callback body"""
+	if not isinstance(data, dict):
+		return False
+
+	body = data.get("Body")
+	if not isinstance(body, dict):
+		return False
+
+	callback = body.get("stkCallback")
+	if not isinstance(callback, dict):
+		return False
+
+	checkout_request_id = callback.get("CheckoutRequestID")
+	if not isinstance(checkout_request_id, str) or not 0 < len(checkout_request_id) <= 64:
+		return False
+
+	result_code = callback.get("ResultCode")
+	return isinstance(result_code, int) and not isinstance(result_code, bool)
+
+
+def is_valid_c2b_payload(data):
+	"""Return True if `data` looks like a C2B confirmation body"""
+	if not isinstance(data, dict):
+		return False
+
+	trans_id = data.get("TransID")
+	if not isinstance(trans_id, str) or not 0 < len(trans_id) <= 32:
+		return False
+
+	bill_ref = data.get("BillRefNumber")
+	if not isinstance(bill_ref, str) or not 0 < len(bill_ref) <= 140:
+		return False
+
+	try:
+		return float(data.get("TransAmount")) > 0
+	except (TypeError, ValueError):
+		return False
+
+
+def get_source_ip(request, trusted_proxies):
+	"""Return the client address as seen by the outermost trusted proxy.
+
+	Entries to the left of the trusted hops in `X-Forwarded-For` are supplied by the
+	client, so they are ignored. `frappe.local.request_ip` uses the first entry and
+	can be forged.
+	"""
+	if trusted_proxies <= 0:
+		return request.remote_addr
+
+	hops = [hop.strip() for hop in (request.headers.get("X-Forwarded-For") or "").split(",")]
+	hops = [hop for hop in hops if hop]
+	if len(hops) < trusted_proxies:
+		return request.remote_addr
+
+	return hops[-trusted_proxies]
+
+
+def record_rejection(reason):
+	"""Count a rejected callback without touching the database"""
+	cache = frappe.cache()
+	super(RedisWrapper, cache).hincrby(cache.make_key(REJECTION_COUNTER_KEY), reason, 1)
+
+
+def get_rejection_counts():
+	"""Return the rejection counters keyed by reason"""
+	# Counters are plain Redis integers, so bypass the wrapper's key prefixing and pickling
+	cache = frappe.cache()
+	counts = super(RedisWrapper, cache).hgetall(cache.make_key(REJECTION_COUNTER_KEY)) or {}
+	return {
+		frappe.safe_decode(reason): cint(frappe.safe_decode(count)) for reason, count in counts.items()
+	}
+
+
+def _reject(reason):
+	record_rejection(reason)
+	return None
+
+
+def _ip_allowed(source_ip, allowed_ips):
+	"""An empty allowlist accepts every source"""
+	networks = _parse_allowlist(allowed_ips)
+	if not networks:
+		return True
+
+	try:
+		address = ipaddress.ip_address(source_ip)
+	except ValueError:
+		return False
+
+	return any(address in network for network in networks)
+
+
+def _parse_allowlist(allowed_ips):
+	networks = []
+	for entry in (allowed_ips or "").replace(",", "\n").splitlines():
+		entry = entry.strip()
+		if not entry:
+			continue
+		try:
+			networks.append(ipaddress.ip_network(entry, strict=False))
+		except ValueError:
+			continue
+	return networks
+
+
+def _rate_limited(source_ip, limit):
+	"""Fixed-window request counter per source IP"""
+	limit = cint(limit) or DEFAULT_RATE_LIMIT
+	window = int(time.time()) // RATE_LIMIT_WINDOW
+
+	cache = frappe.cache()
+	redis = super(RedisWrapper, cache)
+	key = cache.make_key(f"mpesa:callback_rate:{source_ip}:{window}")
+	hits = redis.incr(key)
+	if hits == 1:
+		redis.expire(key, RATE_LIMIT_WINDOW)
+
+	return hits > limit
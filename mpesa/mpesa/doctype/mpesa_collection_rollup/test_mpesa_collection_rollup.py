@@ -0,0 +1,51 @@
+# Copyright (c) 2026, Naphtali and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from mpesa.mpesa.rollup import apply_delta, get_bucket, get_rollup_name, rebuild_rollups
+
+
+class TestMpesaCollectionRollup(FrappeTestCase):
+	def get_rollup(self, payment, status):
+		name = get_rollup_name(dict(get_bucket(payment), status=status))
+		return frappe.db.get_value(
+			"Mpesa Collection Rollup", name, ["payment_count", "total_amount"], as_dict=True
+		)
+
+	def test_status_transition_moves_payment_between_buckets(self):
+		payment = frappe.get_doc(
+			{"doctype": "Mpesa Payment", "amount": 150, "phone_number": "254700000000", "shortcode": "174379"}
+		).insert(ignore_permissions=True)
+
+		initiated = self.get_rollup(payment, "Initiated")
+		self.assertEqual(initiated.payment_count, 1)
+		self.assertEqual(initiated.total_amount, 150)
+
+		payment.status = "Completed"
+		payment.save(ignore_permissions=True)
+
+		self.assertEqual(self.get_rollup(payment, "Initiated").payment_count, 0)
+		completed = self.get_rollup(payment, "Completed")
+		self.assertEqual(completed.payment_count, 1)
+		self.assertEqual(completed.total_amount, 150)
+
+	def test_rebuild_overwrites_drifted_buckets(self):
+		# a shortcode of its own keeps other payments out of the bucket
+		shortcode = frappe.generate_hash(length=6)
+		payment = frappe.get_doc(
+			{"doctype": "Mpesa Payment", "amount": 80, "phone_number": "254700000000", "shortcode": shortcode}
+		).insert(ignore_permissions=True)
+		apply_delta(dict(get_bucket(payment), status="Initiated"), 5, 500)
+		apply_delta(dict(get_bucket(payment), status="Failed"), 1, 80)
+
+		with patch.object(frappe.db, "commit"):
+			rebuild_rollups(payment.creation, payment.creation)
+
+		rebuilt = self.get_rollup(payment, "Initiated")
+		self.assertEqual(rebuilt.payment_count, 1)
+		self.assertEqual(rebuilt.total_amount, 80)
+		self.assertIsNone(self.get_rollup(payment, "Failed"))
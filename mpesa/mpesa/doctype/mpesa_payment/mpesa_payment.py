@@ -3,6 +3,103 @@
 
 import frappe
 from frappe.model.document import Document
+from frappe.utils import add_to_date, cint, now_datetime
 
-class MpesaPayment(Document):
+from mpesa.mpesa.rollup import record_bulk_transition, record_status_transition
+
+OPEN_STATUSES = ("Initiated", "Pending")
+
+# Late results are still accepted after a payment was expired or cancelled locally,
+# because the customer may have paid on Daraja's side regardless.
+STATUS_TRANSITIONS = {
+    "Initiated": {"Pending", "Completed", "Failed", "Cancelled", "Expired"},
+    "Pending": {"Completed", "Failed", "Cancelled", "Expired"},
+    "Failed": {"Cancelled"},
+    "Cancelled": {"Completed"},
+    "Expired": {"Completed", "Failed", "Cancelled"},
+    "Completed": set(),
+}
+
+DEFAULT_STK_EXPIRY_SECONDS = 300
+DEFAULT_QR_EXPIRY_SECONDS = 600
+EXPIRY_BATCH_SIZE = 500
+
+
+class InvalidStatusTransitionError(frappe.ValidationError):
     pass
+
+
+class MpesaPayment(Document):
+    def validate(self):
+        doc_before_save = self.get_doc_before_save()
+        if doc_before_save:
+            validate_status_transition(doc_before_save.status, self.status)
+
+    def on_update(self):
+        doc_before_save = self.get_doc_before_save()
+        old_status = doc_before_save.status if doc_before_save else None
+        record_status_transition(self, old_status, self.status)
+
+
+def is_valid_status_transition(old_status, new_status):
+    return old_status == new_status or new_status in STATUS_TRANSITIONS.get(old_status, set())
+
+
+def validate_status_transition(old_status, new_status):
+    if not is_valid_status_transition(old_status, new_status):
+        frappe.throw(
+            f"Mpesa Payment cannot move from {old_status} to {new_status}",
+            InvalidStatusTransitionError,
+        )
+
+
+def expire_abandoned_payments():
+    """Scheduled job: mark open payments past Daraja's window as Expired.
+
+    Works in batches with one indexed SELECT and one UPDATE each, instead of
+    saving every document, and moves the batch between rollup buckets in bulk.
+    """
+    settings = frappe.get_cached_doc("Mpesa Settings")
+    windows = {
+        "STK Push": cint(settings.stk_expiry_seconds) or DEFAULT_STK_EXPIRY_SECONDS,
+        "Dynamic QR": cint(settings.qr_expiry_seconds) or DEFAULT_QR_EXPIRY_SECONDS,
+    }
+
+    for channel, seconds in windows.items():
+        cutoff = add_to_date(now_datetime(), seconds=-seconds)
+        while expire_batch(channel, cutoff) == EXPIRY_BATCH_SIZE:
+            pass
+
+
+def expire_batch(channel, cutoff):
+    batch = frappe.db.sql(
+        """
+        select name, status, amount, creation, company, shortcode, pos_invoice
+        from `tabMpesa Payment`
+        where status in %(open_statuses)s and creation < %(cutoff)s and channel = %(channel)s
+        order by creation
+        limit %(limit)s
+        for update
+        """,
+        {"open_statuses": OPEN_STATUSES, "cutoff": cutoff, "channel": channel, "limit": EXPIRY_BATCH_SIZE},
+        as_dict=True,
+    )
+    if not batch:
+        return 0
+
+    frappe.db.sql(
+        """
+        update `tabMpesa Payment`
+        set status = 'Expired', modified = %(now)s
+        where name in %(names)s and status in %(open_statuses)s
+        """,
+        {"now": now_datetime(), "names": [row.name for row in batch], "open_statuses": OPEN_STATUSES},
+    )
+    record_bulk_transition(batch, "Expired")
+    frappe.db.commit()
+
+    return len(batch)
+
+
+def on_doctype_update():
+    frappe.db.add_index("Mpesa Payment", ["status", "creation"])
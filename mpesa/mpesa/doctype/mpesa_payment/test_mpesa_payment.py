@@ -1,9 +1,50 @@
 # Copyright (c) 2025, Naphtali and Contributors
 # See license.txt
 
-# import frappe
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, now_datetime
+
+from mpesa.mpesa.doctype.mpesa_payment.mpesa_payment import (
+	InvalidStatusTransitionError,
+	expire_abandoned_payments,
+)
 
 
 class TestMpesaPayment(FrappeTestCase):
-	pass
+	def make_payment(self, **kwargs):
+		return frappe.get_doc(
+			{"doctype": "Mpesa Payment", "amount": 100, "phone_number": "254700000000", **kwargs}
+		).insert(ignore_permissions=True)
+
+	def test_completed_payment_cannot_change_status(self):
+		payment = self.make_payment()
+		payment.status = "Completed"
+		payment.save(ignore_permissions=True)
+
+		payment.status = "Initiated"
+		self.assertRaises(InvalidStatusTransitionError, payment.save, ignore_permissions=True)
+
+	def test_expire_abandoned_payments(self):
+		abandoned = self.make_payment()
+		recent = self.make_payment()
+		frappe.db.set_value(
+			"Mpesa Payment",
+			abandoned.name,
+			"creation",
+			add_to_date(now_datetime(), hours=-1),
+			update_modified=False,
+		)
+
+		with patch.object(frappe.db, "commit"):
+			expire_abandoned_payments()
+
+		self.assertEqual(frappe.db.get_value("Mpesa Payment", abandoned.name, "status"), "Expired")
+		self.assertEqual(frappe.db.get_value("Mpesa Payment", recent.name, "status"), "Initiated")
+
+		# a late result from Daraja still completes an expired payment
+		abandoned.reload()
+		abandoned.status = "Completed"
+		abandoned.save(ignore_permissions=True)
@@ -0,0 +1,129 @@
+import frappe
+import requests
+from frappe.utils import cint, flt
+
+from mpesa.mpesa.api import get_access_token
+from mpesa.mpesa.doctype.mpesa_payment.mpesa_payment import DEFAULT_QR_EXPIRY_SECONDS, OPEN_STATUSES
+
+DEFAULT_QR_CACHE_TTL = 600
+QR_SIZE = "300"
+
+
+@frappe.whitelist()
+def generate_qr_code(pos_invoice_name, amount):
+	"""Return a Daraja Dynamic QR code for a POS Invoice.
+
+	QR payloads are cached per invoice and amount, so reprints and screen refreshes
+	reuse the same code and Mpesa Payment instead of calling Daraja again. Payment
+	is matched back through the C2B confirmation callback.
+	"""
+	# Daraja only accepts whole shillings. Rounding here would charge a different amount
+	# than the invoice's payment row, so the client must send the rounded total.
+	amount = flt(amount, 2)
+	if amount <= 0:
+		frappe.throw("QR payment amount must be greater than 0.")
+	if not amount.is_integer():
+		frappe.throw(f"QR payment amount must be a whole number of shillings, got {amount}.")
+	amount = int(amount)
+
+	invoice = frappe.db.get_value("POS Invoice", pos_invoice_name, ["name", "company", "docstatus"],
+								  as_dict=True)
+	if not invoice:
+		frappe.throw(f"POS Invoice {pos_invoice_name} does not exist. Please save the invoice first.")
+	if invoice.docstatus != 0:
+		frappe.throw(f"POS Invoice {pos_invoice_name} is already submitted.")
+
+	cached = get_cached_qr(invoice.name, amount)
+	if cached:
+		return cached
+
+	settings = frappe.get_cached_doc("Mpesa Settings")
+	response_data = request_dynamic_qr(settings, invoice, amount)
+
+	payment_doc = frappe.new_doc("Mpesa Payment")
+	payment_doc.pos_invoice = invoice.name
+	payment_doc.amount = amount
+	payment_doc.company = invoice.company
+	payment_doc.shortcode = settings.shortcode
+	payment_doc.channel = "Dynamic QR"
+	payment_doc.status = "Initiated"
+	payment_doc.merchant_request_id = response_data.get("RequestID")
+	payment_doc.result_code = response_data.get("ResponseCode")
+	payment_doc.result_desc = response_data.get("ResponseDescription")
+	payment_doc.insert(ignore_permissions=True)
+	frappe.db.commit()
+
+	qr = {
+		"payment": payment_doc.name,
+		"pos_invoice": invoice.name,
+		"amount": amount,
+		"qr_code": response_data.get("QRCode"),
+		# how long the POS keeps polling for the C2B confirmation
+		"expires_in": cint(settings.qr_expiry_seconds) or DEFAULT_QR_EXPIRY_SECONDS
+	}
+	frappe.cache().set_value(get_qr_cache_key(invoice.name, amount), qr,
+							 expires_in_sec=cint(settings.qr_cache_ttl) or DEFAULT_QR_CACHE_TTL)
+	return qr
+
+
+def get_cached_qr(pos_invoice_name, amount):
+	"""Return the cached QR for an invoice and amount while its payment is still open"""
+	cache = frappe.cache()
+	cache_key = get_qr_cache_key(pos_invoice_name, amount)
+	qr = cache.get_value(cache_key)
+	if not qr:
+		return None
+
+	status = frappe.db.get_value("Mpesa Payment", qr["payment"], "status")
+	if status in OPEN_STATUSES:
+		return qr
+
+	cache.delete_value(cache_key)
+	if status == "Completed":
+		frappe.throw(f"POS Invoice {pos_invoice_name} has already been paid with M-Pesa.")
+	return None
+
+
+def get_qr_cache_key(pos_invoice_name, amount):
+	return f"mpesa:qr:{pos_invoice_name}:{flt(amount):.2f}"
+
+
+def request_dynamic_qr(settings, invoice, amount):
+	"""Call the Daraja Dynamic QR API and return its JSON response"""
+	if not settings.shortcode:
+		frappe.throw("M-Pesa Shortcode is missing in Mpesa Settings.")
+
+	qr_url = ("https://sandbox.safaricom.co.ke/mpesa/qrcode/v1/generate"
+			  if settings.live_test_mode == "Test"
+			  else "https://api.safaricom.co.ke/mpesa/qrcode/v1/generate")
+
+	headers = {
+		"Authorization": f"Bearer {get_access_token()}",
+		"Content-Type": "application/json"
+	}
+
+	payload = {
+		"MerchantName": settings.qr_merchant_name or invoice.company,
+		"RefNo": invoice.name,
+		"Amount": amount,
+		"TrxCode": settings.qr_transaction_code or "PB",
+		"CPI": settings.shortcode,
+		"Size": QR_SIZE
+	}
+
+	try:
+		response = requests.post(qr_url, json=payload, headers=headers, timeout=30)
+		response.raise_for_status()
+		response_data = response.json()
+	except requests.exceptions.RequestException as e:
+		error_msg = f"Dynamic QR request failed: {str(e)[:200]}"
+		frappe.log_error(error_msg, "M-Pesa QR Error")
+		frappe.throw(error_msg)
+	except ValueError:
+		frappe.throw(f"Invalid JSON response from M-Pesa QR API: {response.text[:200]}")
+
+	if not response_data.get("QRCode"):
+		error_msg = response_data.get("ResponseDescription") or response_data.get("errorMessage")
+		frappe.throw(f"M-Pesa did not return a QR code: {error_msg}")
+
+	return response_data
@@ -0,0 +1,51 @@
+// Copyright (c) 2026, Naphtali and contributors
+// For license information, please see license.txt
+
+frappe.query_reports["Mpesa Collections"] = {
+	filters: [
+		{
+			fieldname: "from_date",
+			label: __("From Date"),
+			fieldtype: "Date",
+			default: frappe.datetime.add_days(frappe.datetime.get_today(), -30),
+			reqd: 1,
+		},
+		{
+			fieldname: "to_date",
+			label: __("To Date"),
+			fieldtype: "Date",
+			default: frappe.datetime.get_today(),
+			reqd: 1,
+		},
+		{
+			fieldname: "group_by",
+			label: __("Group By"),
+			fieldtype: "Select",
+			options: "Day\nHour",
+			default: "Day",
+		},
+		{
+			fieldname: "company",
+			label: __("Company"),
+			fieldtype: "Link",
+			options: "Company",
+		},
+		{
+			fieldname: "shortcode",
+			label: __("Shortcode"),
+			fieldtype: "Data",
+		},
+		{
+			fieldname: "status",
+			label: __("Status"),
+			fieldtype: "Select",
+			options: "\nInitiated\nPending\nCompleted\nFailed\nCancelled\nExpired",
+		},
+		{
+			fieldname: "invoice_type",
+			label: __("Invoice Type"),
+			fieldtype: "Select",
+			options: "\nPOS Invoice\nSales Invoice",
+		},
+	],
+};
@@ -0,0 +1,79 @@
+# Copyright (c) 2026, Naphtali and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.utils import flt
+
+
+def execute(filters=None):
+	"""Collections summary read only from Mpesa Collection Rollup, never Mpesa Payment"""
+	filters = frappe._dict(filters or {})
+	by_hour = filters.group_by == "Hour"
+
+	columns = get_columns(by_hour)
+	data = get_data(filters, by_hour)
+	chart = get_chart(data)
+
+	return columns, data, None, chart
+
+
+def get_columns(by_hour):
+	columns = [
+		{"label": _("Date"), "fieldname": "collection_date", "fieldtype": "Date", "width": 110},
+	]
+	if by_hour:
+		columns.append({"label": _("Hour"), "fieldname": "collection_hour", "fieldtype": "Int", "width": 70})
+
+	columns += [
+		{"label": _("Status"), "fieldname": "status", "fieldtype": "Data", "width": 100},
+		{"label": _("Invoice Type"), "fieldname": "invoice_type", "fieldtype": "Data", "width": 120},
+		{"label": _("Payments"), "fieldname": "payment_count", "fieldtype": "Int", "width": 100},
+		{"label": _("Amount"), "fieldname": "total_amount", "fieldtype": "Currency", "width": 140},
+	]
+	return columns
+
+
+def get_data(filters, by_hour):
+	conditions = ["collection_date between %(from_date)s and %(to_date)s"]
+	for fieldname in ("company", "shortcode", "status", "invoice_type"):
+		if filters.get(fieldname):
+			conditions.append(f"{fieldname} = %({fieldname})s")
+
+	group_fields = "collection_date, collection_hour" if by_hour else "collection_date"
+
+	return frappe.db.sql(
+		f"""
+		select {group_fields}, status, invoice_type,
+			sum(payment_count) as payment_count, sum(total_amount) as total_amount
+		from `tabMpesa Collection Rollup`
+		where {" and ".join(conditions)}
+		group by {group_fields}, status, invoice_type
+		having sum(payment_count) != 0
+		order by {group_fields}, status, invoice_type
+		""",
+		filters,
+		as_dict=True,
+	)
+
+
+def get_chart(data):
+	totals = {}
+	for row in data:
+		if row.status == "Completed":
+			label = str(row.collection_date)
+			if row.get("collection_hour") is not None:
+				label += f" {row.collection_hour:02d}:00"
+			totals[label] = totals.get(label, 0) + flt(row.total_amount)
+
+	if not totals:
+		return None
+
+	return {
+		"data": {
+			"labels": list(totals),
+			"datasets": [{"name": _("Completed Collections"), "values": list(totals.values())}],
+		},
+		"type": "bar",
+		"fieldtype": "Currency",
+	}
@@ -0,0 +1,174 @@
+import hashlib
+
+import frappe
+from frappe.utils import add_days, add_to_date, flt, get_datetime, getdate, now_datetime, today
+
+ROLLUP_DOCTYPE = "Mpesa Collection Rollup"
+
+
+def record_status_transition(payment_doc, old_status, new_status):
+	"""Move a payment between rollup buckets when its status changes.
+
+	Buckets are keyed on the payment's creation hour, so the same bucket is hit on
+	every transition and counts never drift between hours.
+	"""
+	if old_status == new_status:
+		return
+
+	bucket = get_bucket(payment_doc)
+	amount = flt(payment_doc.amount)
+
+	if old_status:
+		apply_delta(dict(bucket, status=old_status), -1, -amount)
+	if new_status:
+		apply_delta(dict(bucket, status=new_status), 1, amount)
+
+
+def record_bulk_transition(payments, new_status):
+	"""Move a batch of payments to `new_status` with one upsert per affected bucket"""
+	deltas = {}
+	for payment in payments:
+		if payment.status == new_status:
+			continue
+
+		bucket = get_bucket(payment)
+		amount = flt(payment.amount)
+		for status, sign in ((payment.status, -1), (new_status, 1)):
+			key = tuple(dict(bucket, status=status).items())
+			count, total = deltas.get(key, (0, 0))
+			deltas[key] = (count + sign, total + sign * amount)
+
+	for key, (count, total) in deltas.items():
+		apply_delta(dict(key), count, total)
+
+
+def get_bucket(payment_doc):
+	created = get_datetime(payment_doc.creation)
+	return {
+		"collection_date": created.date(),
+		"collection_hour": created.hour,
+		"company": payment_doc.company or "",
+		"shortcode": payment_doc.shortcode or "",
+		"invoice_type": "POS Invoice" if payment_doc.pos_invoice else "Sales Invoice",
+	}
+
+
+def get_rollup_name(key):
+	parts = [
+		str(getdate(key["collection_date"])),
+		str(key["collection_hour"]),
+		key["company"] or "",
+		key["shortcode"] or "",
+		key["status"],
+		key["invoice_type"],
+	]
+	return hashlib.md5("|".join(parts).encode("utf-8")).hexdigest()[:20]
+
+
+def apply_delta(key, count, amount):
+	"""Atomically add `count` and `amount` to a rollup row, creating it if needed"""
+	_upsert_rollup(key, count, amount, accumulate=True)
+
+
+def set_rollup(key, count, amount):
+	"""Overwrite a rollup row with absolute values, creating it if needed"""
+	_upsert_rollup(key, count, amount, accumulate=False)
+
+
+def _upsert_rollup(key, count, amount, accumulate):
+	values = dict(
+		key,
+		name=get_rollup_name(key),
+		payment_count=count,
+		total_amount=amount,
+		now=now_datetime(),
+		user=frappe.session.user,
+	)
+
+	if accumulate:
+		update = """
+			payment_count = payment_count + values(payment_count),
+			total_amount = total_amount + values(total_amount),"""
+	else:
+		update = """
+			payment_count = values(payment_count),
+			total_amount = values(total_amount),"""
+
+	frappe.db.sql(
+		f"""
+		insert into `tabMpesa Collection Rollup`
+			(name, creation, modified, owner, modified_by, docstatus,
+			collection_date, collection_hour, company, shortcode, status, invoice_type,
+			payment_count, total_amount)
+		values
+			(%(name)s, %(now)s, %(now)s, %(user)s, %(user)s, 0,
+			%(collection_date)s, %(collection_hour)s, %(company)s, %(shortcode)s, %(status)s,
+			%(invoice_type)s, %(payment_count)s, %(total_amount)s)
+		on duplicate key update{update}
+			modified = values(modified)
+		""",
+		values,
+	)
+
+
+def rebuild_rollups(from_date, to_date=None):
+	"""Recompute rollup rows for a date range from `Mpesa Payment`.
+
+	Used to backfill history and to correct any drift from writes that bypass the
+	document controller. Bucket keys are built exactly like `get_bucket`, from the
+	payment's own columns.
+
+	Works one creation hour per transaction, so the row locks taken by
+	`rebuild_rollup_hour` only ever hold up callbacks for that hour briefly.
+	"""
+	hour = get_datetime(getdate(from_date))
+	end = get_datetime(add_days(getdate(to_date or today()), 1))
+
+	while hour < end:
+		rebuild_rollup_hour(hour)
+		frappe.db.commit()
+		hour = add_to_date(hour, hours=1)
+
+
+def rebuild_rollup_hour(hour):
+	"""Overwrite the rollup rows of one creation hour with absolute values.
+
+	The aggregate is a locking read, so status changes in the hour wait for this
+	transaction and then apply their deltas on top of the recomputed values instead
+	of being lost.
+	"""
+	rows = frappe.db.sql(
+		"""
+		select
+			date(creation) as collection_date,
+			hour(creation) as collection_hour,
+			coalesce(company, '') as company,
+			coalesce(shortcode, '') as shortcode,
+			status,
+			if(coalesce(pos_invoice, '') != '', 'POS Invoice', 'Sales Invoice') as invoice_type,
+			count(*) as payment_count,
+			sum(amount) as total_amount
+		from `tabMpesa Payment`
+		where creation >= %(start)s and creation < %(end)s
+		group by collection_date, collection_hour, company, shortcode, status, invoice_type
+		for update
+		""",
+		{"start": hour, "end": add_to_date(hour, hours=1)},
+		as_dict=True,
+	)
+
+	names = []
+	for row in rows:
+		names.append(get_rollup_name(row))
+		set_rollup(row, row.pop("payment_count"), flt(row.pop("total_amount")))
+
+	# Buckets with no payments left in the hour
+	filters = {"collection_date": hour.date(), "collection_hour": hour.hour}
+	if names:
+		filters["name"] = ["not in", names]
+	frappe.db.delete(ROLLUP_DOCTYPE, filters)
+
+
+def reconcile_recent_rollups():
+	"""Scheduled delta job: recompute yesterday and today"""
+	rebuild_rollups(add_days(today(), -1))
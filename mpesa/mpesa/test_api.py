@@ -0,0 +1,249 @@
+# Copyright (c) 2026, Naphtali and Contributors
+# See license.txt
+
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from mpesa.mpesa.api import (
+	TOKEN_REFRESH_FAILED_KEY,
+	create_payment_entries,
+	get_payment_status,
+	initiate_stk_push,
+	process_stk_callback,
+	refresh_access_token,
+	resend_stk_push,
+	save_and_pay,
+)
+from mpesa.mpesa.callback_filter import get_rejection_counts
+from mpesa.mpesa.throttle import stk_busy_response
+
+
+class TestMpesaApi(FrappeTestCase):
+	def setUp(self):
+		self.checkout_request_id = f"ws_CO_{frappe.generate_hash(length=10)}"
+		self.payment = frappe.get_doc(
+			{
+				"doctype": "Mpesa Payment",
+				"amount": 100,
+				"phone_number": "254700000000",
+				"checkout_request_id": self.checkout_request_id,
+			}
+		).insert(ignore_permissions=True)
+
+	def make_callback(self, result_code, items=None):
+		callback = {
+			"MerchantRequestID": "29115-34620561-1",
+			"CheckoutRequestID": self.checkout_request_id,
+			"ResultCode": result_code,
+			"ResultDesc": "Processed",
+		}
+		if items:
+			callback["CallbackMetadata"] = {"Item": items}
+		return callback
+
+	def test_get_payment_status_is_single_query(self):
+		with self.assertQueryCount(1):
+			status = get_payment_status(self.checkout_request_id)
+
+		self.assertEqual(status.status, "Initiated")
+		self.assertEqual(status.amount, 100)
+
+	def test_failed_callback_does_not_load_documents(self):
+		# one read, one update and two rollup upserts
+		with patch.object(frappe.db, "commit"), self.assertQueryCount(4):
+			response = process_stk_callback(self.make_callback(1032))
+
+		self.assertEqual(response["status"], "success")
+		self.assertEqual(frappe.db.get_value("Mpesa Payment", self.payment.name, "status"), "Failed")
+
+	def test_completed_pos_callback_skips_invoice_load(self):
+		frappe.db.set_value("Mpesa Payment", self.payment.name, "pos_invoice", "POS-TEST-0001")
+		items = [{"Name": "MpesaReceiptNumber", "Value": "NLJ7RT61SV"}]
+
+		with patch.object(frappe.db, "commit"), self.assertQueryCount(4):
+			process_stk_callback(self.make_callback(0, items))
+
+		payment = frappe.db.get_value(
+			"Mpesa Payment", self.payment.name, ["status", "receipt_number"], as_dict=True
+		)
+		self.assertEqual(payment.status, "Completed")
+		self.assertEqual(payment.receipt_number, "NLJ7RT61SV")
+
+	def test_unknown_checkout_request_is_counted_not_logged(self):
+		before = get_rejection_counts().get("unknown", 0)
+		callback = dict(self.make_callback(0), CheckoutRequestID="ws_CO_unknown")
+
+		with patch("frappe.log_error") as log_error:
+			response = process_stk_callback(callback)
+
+		self.assertEqual(response["status"], "error")
+		log_error.assert_not_called()
+		self.assertEqual(get_rejection_counts()["unknown"], before + 1)
+
+	def make_sales_invoice(self):
+		# Inserted without validation; only the columns the payment paths read are set
+		sales_invoice = frappe.get_doc(
+			{
+				"doctype": "Sales Invoice",
+				"name": f"SINV-TEST-{frappe.generate_hash(length=8)}",
+				"customer": "_Test Customer",
+				"company": "_Test Company",
+				"grand_total": 100,
+				"outstanding_amount": 100,
+			}
+		)
+		sales_invoice.db_insert()
+		return sales_invoice.name
+
+	def test_initiate_stk_push_reads_invoice_columns_only(self):
+		sales_invoice = self.make_sales_invoice()
+		frappe.get_cached_doc("Mpesa Settings")
+
+		with patch("mpesa.mpesa.api._initiate_for_invoice") as initiate, self.assertQueryCount(1):
+			initiate_stk_push("254700000000", 100, sales_invoice_name=sales_invoice)
+
+		invoice = initiate.call_args.args[4]
+		self.assertEqual(initiate.call_args.args[3], "Sales Invoice")
+		self.assertEqual(invoice.name, sales_invoice)
+		self.assertEqual(invoice.company, "_Test Company")
+
+	def test_initiate_stk_push_for_missing_invoice(self):
+		with patch("mpesa.mpesa.api._initiate_for_invoice") as initiate:
+			self.assertRaises(
+				frappe.ValidationError, initiate_stk_push, "254700000000", 100, sales_invoice_name="SINV-MISSING"
+			)
+
+		initiate.assert_not_called()
+
+	def test_resend_query_count(self):
+		replacement = {"ResponseCode": "0", "CheckoutRequestID": "ws_CO_replacement"}
+
+		# two payment reads, one update and two rollup upserts
+		with patch("mpesa.mpesa.api.initiate_stk_push", return_value=replacement), patch.object(
+			frappe.db, "commit"
+		), self.assertQueryCount(5):
+			resend_stk_push(self.checkout_request_id)
+
+	def test_sales_invoice_payment_entry_reads_invoice_columns_only(self):
+		payment = frappe._dict(
+			name=self.payment.name,
+			amount=100,
+			receipt_number=f"NLJ{frappe.generate_hash(length=7).upper()}",
+			sales_invoice=self.make_sales_invoice(),
+		)
+
+		# one duplicate check and one invoice read
+		with patch("mpesa.mpesa.api.get_mpesa_account", return_value="M-Pesa - _TC"), patch(
+			"frappe.new_doc"
+		) as new_doc, self.assertQueryCount(2):
+			create_payment_entries(payment, {})
+
+		payment_entry = new_doc.return_value
+		self.assertEqual(payment_entry.party, "_Test Customer")
+		payment_entry.insert.assert_called_once()
+		payment_entry.submit.assert_called_once()
+
+	def test_busy_resend_keeps_original_payment(self):
+		with patch("mpesa.mpesa.api.initiate_stk_push", return_value=stk_busy_response()):
+			response = resend_stk_push(self.checkout_request_id)
+
+		self.assertTrue(response["busy"])
+		self.assertEqual(frappe.db.get_value("Mpesa Payment", self.payment.name, "status"), "Initiated")
+
+	def test_accepted_resend_cancels_original_payment(self):
+		replacement = {"ResponseCode": "0", "CheckoutRequestID": "ws_CO_replacement"}
+		with patch("mpesa.mpesa.api.initiate_stk_push", return_value=replacement), patch.object(
+			frappe.db, "commit"
+		):
+			resend_stk_push(self.checkout_request_id)
+
+		self.assertEqual(frappe.db.get_value("Mpesa Payment", self.payment.name, "status"), "Cancelled")
+
+	def save_and_pay(self, stk_response=None, stk_error=None):
+		doc = {"doctype": "POS Invoice", "name": "new-pos-invoice-1", "__islocal": 1, "docstatus": 0}
+
+		def save(invoice_doc):
+			invoice_doc.name = "POS-TEST-0001"
+
+		with patch("frappe.model.document.Document.save", autospec=True, side_effect=save), patch(
+			"mpesa.mpesa.api.send_updated_docs"
+		), patch(
+			"mpesa.mpesa.api._initiate_for_invoice", return_value=stk_response, side_effect=stk_error
+		) as initiate:
+			response = save_and_pay(frappe.as_json(doc), "254700000000", 100)
+
+		return response, initiate
+
+	def test_save_and_pay_pushes_for_saved_invoice(self):
+		accepted = {"ResponseCode": "0", "CheckoutRequestID": "ws_CO_saved"}
+		response, initiate = self.save_and_pay(stk_response=accepted)
+
+		self.assertEqual(response["pos_invoice"], "POS-TEST-0001")
+		self.assertEqual(response["checkout_request_id"], "ws_CO_saved")
+		invoice_doc = initiate.call_args.args[4]
+		self.assertEqual(invoice_doc.name, "POS-TEST-0001")
+		self.assertEqual(invoice_doc.localname, "new-pos-invoice-1")
+
+	def test_save_and_pay_passes_busy_response_through(self):
+		response, _initiate = self.save_and_pay(stk_response=stk_busy_response())
+
+		self.assertEqual(response["pos_invoice"], "POS-TEST-0001")
+		self.assertTrue(response["stk_response"]["busy"])
+
+	def test_save_and_pay_returns_stk_errors_after_saving(self):
+		response, _initiate = self.save_and_pay(stk_error=frappe.ValidationError("STK Push request failed"))
+
+		self.assertEqual(response, {"pos_invoice": "POS-TEST-0001", "error": "STK Push request failed"})
+
+
+class TestTokenRefresh(FrappeTestCase):
+	def setUp(self):
+		frappe.cache().delete_value(TOKEN_REFRESH_FAILED_KEY)
+
+	def tearDown(self):
+		frappe.cache().delete_value(TOKEN_REFRESH_FAILED_KEY)
+
+	def refresh(self, expires_in, error=None):
+		settings = frappe._dict(
+			consumer_key="consumer-key",
+			shortcode="174379",
+			access_token="token",
+			token_expiry=datetime.now() + timedelta(seconds=expires_in),
+		)
+		with patch("frappe.get_single", return_value=settings), patch(
+			"mpesa.mpesa.api._fetch_access_token", side_effect=error
+		) as fetch, patch("mpesa.mpesa.api.notify_token_refresh_failure") as notify, patch.object(
+			frappe.db, "commit"
+		), patch.object(frappe.db, "rollback"):
+			refresh_access_token()
+
+		return fetch, notify
+
+	def test_token_outside_refresh_window_is_kept(self):
+		fetch, _notify = self.refresh(expires_in=2 * 60 * 60)
+
+		fetch.assert_not_called()
+
+	def test_token_inside_refresh_window_is_renewed(self):
+		fetch, notify = self.refresh(expires_in=5 * 60)
+
+		fetch.assert_called_once()
+		notify.assert_not_called()
+
+	def test_failure_alerts_once_per_streak(self):
+		_fetch, first = self.refresh(expires_in=5 * 60, error=Exception("timeout"))
+		_fetch, second = self.refresh(expires_in=5 * 60, error=Exception("timeout"))
+
+		first.assert_called_once_with("timeout")
+		second.assert_not_called()
+
+	def test_success_clears_failure_flag(self):
+		self.refresh(expires_in=5 * 60, error=Exception("timeout"))
+		self.refresh(expires_in=5 * 60)
+
+		self.assertIsNone(frappe.cache().get_value(TOKEN_REFRESH_FAILED_KEY))
+		_fetch, notify = self.refresh(expires_in=5 * 60, error=Exception("timeout"))
+		notify.assert_called_once()
@@ -0,0 +1,132 @@
+# Copyright (c) 2026, Naphtali and Contributors
+# See license.txt
+
+import gzip
+import json
+import os
+import tempfile
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from mpesa.mpesa.callback_capture import (
+	_make_http_sender,
+	build_schedule,
+	capture_callback,
+	export_captures,
+	get_expected_statuses,
+	redact_payload,
+	restore_payments,
+	strip_redacted_fields,
+)
+
+
+class TestCallbackCapture(FrappeTestCase):
+	def make_capture(self, checkout_request_id, result_code):
+		return {
+			"kind": "stk",
+			"body": {
+				"Body": {
+					"stkCallback": {
+						"CheckoutRequestID": checkout_request_id,
+						"ResultCode": result_code,
+						"CallbackMetadata": {"Item": [{"Name": "PhoneNumber", "Value": 254712345678}]},
+					}
+				}
+			},
+		}
+
+	def test_redaction_masks_phone_numbers(self):
+		capture = self.make_capture("ws_CO_1", 0)
+		redacted = redact_payload("stk", capture["body"])
+
+		item = redacted["Body"]["stkCallback"]["CallbackMetadata"]["Item"][0]
+		self.assertEqual(item["Value"], "2547*****678")
+		# the original payload is left untouched
+		self.assertEqual(capture["body"]["Body"]["stkCallback"]["CallbackMetadata"]["Item"][0]["Value"], 254712345678)
+
+		c2b = redact_payload("c2b", {"TransID": "NLJ7RT61SV", "MSISDN": "254712345678", "FirstName": "John"})
+		self.assertEqual(c2b["TransID"], "NLJ7RT61SV")
+		self.assertEqual(c2b["MSISDN"], "2547*****678")
+		self.assertEqual(c2b["FirstName"], "****")
+
+	def test_schedule_duplicates_and_expected_statuses(self):
+		captures = [self.make_capture(f"ws_CO_{i}", i % 2) for i in range(10)]
+
+		schedule = build_schedule(captures, duplicate_rate=1, shuffle=True, seed=1)
+		self.assertEqual(len(schedule), 20)
+
+		expected = get_expected_statuses(captures)
+		self.assertEqual(expected["stk"]["ws_CO_0"], "Completed")
+		self.assertEqual(expected["stk"]["ws_CO_1"], "Failed")
+
+	def test_replay_strips_redacted_fields(self):
+		capture = self.make_capture("ws_CO_1", 0)
+		capture["body"] = redact_payload("stk", capture["body"])
+		items = capture["body"]["Body"]["stkCallback"]["CallbackMetadata"]["Item"]
+		items.append({"Name": "MpesaReceiptNumber", "Value": "NLJ7RT61SV"})
+
+		stripped = strip_redacted_fields(capture)
+		self.assertEqual(
+			stripped["body"]["Body"]["stkCallback"]["CallbackMetadata"]["Item"],
+			[{"Name": "MpesaReceiptNumber", "Value": "NLJ7RT61SV"}],
+		)
+
+		c2b = strip_redacted_fields(
+			{"kind": "c2b", "body": {"TransID": "NLJ7RT61SV", "MSISDN": "2547*****678", "FirstName": "****"}}
+		)
+		self.assertEqual(c2b["body"], {"TransID": "NLJ7RT61SV"})
+
+	def test_restore_resets_payment_and_keeps_phone_number(self):
+		payment = frappe.get_doc(
+			{
+				"doctype": "Mpesa Payment",
+				"amount": 100,
+				"phone_number": "254712345678",
+				"checkout_request_id": f"ws_CO_{frappe.generate_hash(length=10)}",
+				"status": "Completed",
+				"receipt_number": "NLJ7RT61SV",
+			}
+		).insert(ignore_permissions=True)
+		row = {"name": payment.name, "channel": "STK Push", "checkout_request_id": payment.checkout_request_id}
+
+		with patch.object(frappe.db, "commit"):
+			self.assertEqual(restore_payments([row]), 1)
+
+		restored = frappe.db.get_value(
+			"Mpesa Payment", payment.name, ["status", "receipt_number", "phone_number"], as_dict=True
+		)
+		self.assertEqual(restored.status, "Pending")
+		self.assertIsNone(restored.receipt_number)
+		self.assertEqual(restored.phone_number, "254712345678")
+
+	def test_capture_export_and_clear(self):
+		# a key of its own so the site's real capture buffer is left alone
+		capture_key = f"mpesa:callback_capture:test:{frappe.generate_hash(length=8)}"
+		settings = frappe._dict(capture_callbacks=1, callback_capture_limit=10)
+		path = os.path.join(tempfile.mkdtemp(), "captures.jsonl.gz")
+
+		with patch("mpesa.mpesa.callback_capture.CAPTURE_KEY", capture_key), patch(
+			"frappe.get_cached_doc", return_value=settings
+		):
+			capture_callback("stk", self.make_capture("ws_CO_1", 0)["body"])
+			self.assertEqual(export_captures(path, clear=True), 1)
+			self.assertEqual(frappe.cache().lrange(capture_key, 0, -1), [])
+
+		with gzip.open(path, "rt", encoding="utf-8") as f:
+			record = json.loads(f.readline())
+		self.assertEqual(record["body"]["Body"]["stkCallback"]["CheckoutRequestID"], "ws_CO_1")
+
+	def test_http_replay_reports_prefilter_rejections(self):
+		response = MagicMock(status_code=200)
+		response.json.return_value = {"message": {"status": "error", "message": "Rejected"}}
+
+		with patch("requests.Session.post", return_value=response) as post:
+			send = _make_http_sender("http://localhost/api/method/mpesa.mpesa.api.handle_callback")
+			self.assertEqual(send(self.make_capture("ws_CO_1", 0)), "rejected")
+
+			response.json.return_value = {"message": {"status": "success"}}
+			self.assertEqual(send(self.make_capture("ws_CO_1", 0)), "ok")
+
+		self.assertEqual(post.call_count, 2)
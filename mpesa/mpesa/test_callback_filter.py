@@ -0,0 +1,70 @@
+# Copyright (c) 2026, Naphtali and Contributors
+# See license.txt
+
+from types import SimpleNamespace
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from mpesa.mpesa.callback_filter import (
+	_ip_allowed,
+	_rate_limited,
+	_reject,
+	get_rejection_counts,
+	get_source_ip,
+	is_valid_callback_payload,
+)
+
+
+class TestCallbackFilter(FrappeTestCase):
+	def make_payload(self, **callback):
+		return {"Body": {"stkCallback": {"CheckoutRequestID": "ws_CO_1", "ResultCode": 0, **callback}}}
+
+	def test_callback_payload_shape(self):
+		self.assertTrue(is_valid_callback_payload(self.make_payload()))
+		self.assertTrue(is_valid_callback_payload(self.make_payload(ResultCode=1032)))
+
+		self.assertFalse(is_valid_callback_payload([]))
+		self.assertFalse(is_valid_callback_payload({"Body": "x"}))
+		self.assertFalse(is_valid_callback_payload({"Body": {}}))
+		self.assertFalse(is_valid_callback_payload(self.make_payload(CheckoutRequestID="")))
+		self.assertFalse(is_valid_callback_payload(self.make_payload(CheckoutRequestID="x" * 65)))
+		self.assertFalse(is_valid_callback_payload(self.make_payload(CheckoutRequestID=123)))
+		self.assertFalse(is_valid_callback_payload(self.make_payload(ResultCode="0")))
+		self.assertFalse(is_valid_callback_payload(self.make_payload(ResultCode=True)))
+
+	def test_ip_allowlist(self):
+		self.assertTrue(_ip_allowed("203.0.113.5", ""))
+		self.assertTrue(_ip_allowed("203.0.113.5", None))
+
+		allowlist = "196.201.214.200\n196.201.212.0/24, not-an-ip"
+		self.assertTrue(_ip_allowed("196.201.214.200", allowlist))
+		self.assertTrue(_ip_allowed("196.201.212.74", allowlist))
+		self.assertFalse(_ip_allowed("196.201.214.201", allowlist))
+		self.assertFalse(_ip_allowed("garbage", allowlist))
+
+	def test_source_ip_ignores_client_forwarded_hops(self):
+		# nginx appends the real peer to whatever X-Forwarded-For the client sent
+		request = SimpleNamespace(
+			remote_addr="127.0.0.1", headers={"X-Forwarded-For": "196.201.214.200, 203.0.113.5"}
+		)
+
+		self.assertEqual(get_source_ip(request, 1), "203.0.113.5")
+		self.assertEqual(get_source_ip(request, 2), "196.201.214.200")
+		self.assertEqual(get_source_ip(request, 0), "127.0.0.1")
+		self.assertEqual(get_source_ip(SimpleNamespace(remote_addr="127.0.0.1", headers={}), 1), "127.0.0.1")
+
+	def test_rate_limiter(self):
+		source_ip = f"test-{frappe.generate_hash(length=10)}"
+
+		self.assertEqual([_rate_limited(source_ip, 3) for _i in range(3)], [False, False, False])
+		self.assertTrue(_rate_limited(source_ip, 3))
+		# other sources have their own window
+		self.assertFalse(_rate_limited(f"{source_ip}-other", 3))
+
+	def test_rejection_counts(self):
+		before = get_rejection_counts().get("shape", 0)
+		_reject("shape")
+		_reject("shape")
+
+		self.assertEqual(get_rejection_counts()["shape"], before + 2)
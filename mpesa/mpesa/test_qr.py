@@ -0,0 +1,105 @@
+# Copyright (c) 2026, Naphtali and Contributors
+# See license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from mpesa.mpesa.api import process_c2b_confirmation
+from mpesa.mpesa.callback_filter import get_rejection_counts
+from mpesa.mpesa.qr import get_cached_qr, get_qr_cache_key
+
+
+class TestMpesaQr(FrappeTestCase):
+	def setUp(self):
+		self.pos_invoice = f"POS-QR-{frappe.generate_hash(length=8)}"
+		self.payment = frappe.get_doc(
+			{
+				"doctype": "Mpesa Payment",
+				"amount": 250,
+				"phone_number": "254700000000",
+				"channel": "Dynamic QR",
+			}
+		).insert(ignore_permissions=True)
+		# Set after insert so the test does not need a real POS Invoice
+		frappe.db.set_value("Mpesa Payment", self.payment.name, "pos_invoice", self.pos_invoice)
+
+	def tearDown(self):
+		frappe.cache().delete_value(get_qr_cache_key(self.pos_invoice, 250))
+
+	def make_confirmation(self, **overrides):
+		data = {
+			"TransactionType": "Pay Bill",
+			"TransID": f"QR{frappe.generate_hash(length=8).upper()}",
+			"TransAmount": "250.00",
+			"BillRefNumber": self.pos_invoice,
+			"MSISDN": "254700000000",
+		}
+		data.update(overrides)
+		return data
+
+	def confirm(self, data):
+		with patch.object(frappe.db, "commit"), patch("frappe.log_error") as log_error:
+			process_c2b_confirmation(data)
+		return log_error
+
+	def get_status(self):
+		return frappe.db.get_value("Mpesa Payment", self.payment.name, "status")
+
+	def test_confirmation_completes_matching_payment(self):
+		data = self.make_confirmation()
+		log_error = self.confirm(data)
+
+		log_error.assert_not_called()
+		payment = frappe.db.get_value(
+			"Mpesa Payment", self.payment.name, ["status", "receipt_number"], as_dict=True
+		)
+		self.assertEqual(payment.status, "Completed")
+		self.assertEqual(payment.receipt_number, data["TransID"])
+
+	def test_wrong_amount_is_not_matched(self):
+		log_error = self.confirm(self.make_confirmation(TransAmount="200.00"))
+
+		log_error.assert_called_once()
+		self.assertEqual(self.get_status(), "Initiated")
+
+	def test_other_paybill_payments_are_only_counted(self):
+		before = get_rejection_counts().get("unmatched", 0)
+		log_error = self.confirm(self.make_confirmation(BillRefNumber="POS-QR-UNKNOWN"))
+
+		log_error.assert_not_called()
+		self.assertEqual(get_rejection_counts()["unmatched"], before + 1)
+		self.assertEqual(self.get_status(), "Initiated")
+
+	def test_duplicate_confirmation_is_ignored_quietly(self):
+		data = self.make_confirmation()
+		self.confirm(data)
+		log_error = self.confirm(data)
+
+		log_error.assert_not_called()
+		self.assertEqual(self.get_status(), "Completed")
+
+	def cache_qr(self):
+		qr = {"payment": self.payment.name, "pos_invoice": self.pos_invoice, "amount": 250, "qr_code": "QR"}
+		frappe.cache().set_value(get_qr_cache_key(self.pos_invoice, 250), qr)
+		return qr
+
+	def test_cached_qr_is_reused_while_payment_is_open(self):
+		qr = self.cache_qr()
+
+		self.assertEqual(get_cached_qr(self.pos_invoice, 250), qr)
+
+	def test_cached_qr_is_dropped_once_payment_expires(self):
+		self.cache_qr()
+		frappe.db.set_value("Mpesa Payment", self.payment.name, "status", "Expired")
+
+		self.assertIsNone(get_cached_qr(self.pos_invoice, 250))
+		self.assertIsNone(frappe.cache().get_value(get_qr_cache_key(self.pos_invoice, 250)))
+
+	def test_cached_qr_for_paid_invoice_is_refused(self):
+		self.cache_qr()
+		frappe.db.set_value("Mpesa Payment", self.payment.name, "status", "Completed")
+
+		self.assertRaises(frappe.ValidationError, get_cached_qr, self.pos_invoice, 250)
+		self.assertIsNone(frappe.cache().get_value(get_qr_cache_key(self.pos_invoice, 250)))
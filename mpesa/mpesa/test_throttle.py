@@ -0,0 +1,65 @@
+# Copyright (c) 2026, Naphtali and Contributors
+# See license.txt
+
+import time
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils.redis_wrapper import RedisWrapper
+
+from mpesa.mpesa.throttle import SLOT_LEASE_SECONDS, acquire_stk_slot, release_stk_slot
+
+
+class TestThrottle(FrappeTestCase):
+	def make_settings(self, shortcode_limit=0, pos_profile_limit=0):
+		return frappe._dict(
+			shortcode=f"test-{frappe.generate_hash(length=8)}",
+			max_inflight_stk_pushes=shortcode_limit,
+			max_inflight_stk_pushes_per_pos_profile=pos_profile_limit,
+		)
+
+	def test_unlimited_settings_always_acquire(self):
+		settings = self.make_settings()
+		lease = acquire_stk_slot(settings, "Till 1")
+
+		self.assertTrue(lease)
+		self.assertEqual(lease["keys"], [])
+		release_stk_slot(lease)
+
+	def test_shortcode_limit(self):
+		settings = self.make_settings(shortcode_limit=2)
+		first = acquire_stk_slot(settings)
+		second = acquire_stk_slot(settings)
+
+		self.assertTrue(first and second)
+		self.assertIsNone(acquire_stk_slot(settings))
+
+		release_stk_slot(first)
+		third = acquire_stk_slot(settings)
+		self.assertTrue(third)
+
+		release_stk_slot(second)
+		release_stk_slot(third)
+
+	def test_pos_profile_limit_is_per_till(self):
+		settings = self.make_settings(pos_profile_limit=1)
+		till_1 = acquire_stk_slot(settings, "Till 1")
+
+		self.assertTrue(till_1)
+		self.assertIsNone(acquire_stk_slot(settings, "Till 1"))
+		till_2 = acquire_stk_slot(settings, "Till 2")
+		self.assertTrue(till_2)
+
+		release_stk_slot(till_1)
+		release_stk_slot(till_2)
+
+	def test_stale_leases_are_trimmed(self):
+		settings = self.make_settings(shortcode_limit=1)
+		cache = frappe.cache()
+		key = cache.make_key(f"mpesa:stk_inflight:{settings.shortcode}")
+		# a lease left behind by a worker that died before releasing it
+		super(RedisWrapper, cache).zadd(key, {"dead-worker": time.time() - SLOT_LEASE_SECONDS - 1})
+
+		lease = acquire_stk_slot(settings)
+		self.assertTrue(lease)
+		release_stk_slot(lease)
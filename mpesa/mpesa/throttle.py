@@ -0,0 +1,83 @@
+import time
+
+import frappe
+from frappe.utils import cint
+
+# Slots are leased rather than counted so a worker that dies mid-request cannot leak
+# capacity: stale members are trimmed on every acquire. The lease must outlast a
+# worst-case push (30 s OAuth call plus 30 s STK call) so a slow request is never
+# trimmed while still in flight.
+SLOT_LEASE_SECONDS = 120
+DEFAULT_RETRY_AFTER = 2
+
+ACQUIRE_SCRIPT = """
+for i, key in ipairs(KEYS) do
+	redis.call('ZREMRANGEBYSCORE', key, '-inf', ARGV[2])
+	local limit = tonumber(ARGV[4 + i])
+	if limit > 0 and redis.call('ZCARD', key) >= limit then
+		return 0
+	end
+end
+for i, key in ipairs(KEYS) do
+	redis.call('ZADD', key, ARGV[1], ARGV[3])
+	redis.call('EXPIRE', key, ARGV[4])
+end
+return 1
+"""
+
+
+def acquire_stk_slot(settings, pos_profile=None):
+	"""Reserve an in-flight STK push slot for the shortcode and POS profile.
+
+	Keys are site-scoped by the cache wrapper. Returns a lease to pass to
+	`release_stk_slot`, or None if any configured limit is already reached.
+	"""
+	scopes = [(f"mpesa:stk_inflight:{settings.shortcode}", cint(settings.max_inflight_stk_pushes))]
+	if pos_profile:
+		scopes.append(
+			(
+				f"mpesa:stk_inflight:{settings.shortcode}:{pos_profile}",
+				cint(settings.max_inflight_stk_pushes_per_pos_profile),
+			)
+		)
+
+	scopes = [(key, limit) for key, limit in scopes if limit > 0]
+	token = frappe.generate_hash(length=12)
+	if not scopes:
+		return {"keys": [], "token": token}
+
+	cache = frappe.cache()
+	keys = [cache.make_key(key) for key, _limit in scopes]
+	now = time.time()
+	acquired = cache.eval(
+		ACQUIRE_SCRIPT,
+		len(keys),
+		*keys,
+		now,
+		now - SLOT_LEASE_SECONDS,
+		token,
+		SLOT_LEASE_SECONDS,
+		*[limit for _key, limit in scopes],
+	)
+	if not cint(acquired):
+		return None
+
+	return {"keys": keys, "token": token}
+
+
+def release_stk_slot(lease):
+	if not lease or not lease["keys"]:
+		return
+
+	cache = frappe.cache()
+	for key in lease["keys"]:
+		cache.zrem(key, lease["token"])
+
+
+def stk_busy_response():
+	"""Retryable response returned instead of queueing when all slots are taken"""
+	return {
+		"busy": 1,
+		"retry_after": DEFAULT_RETRY_AFTER,
+		"ResponseDescription": "M-Pesa is busy, please retry shortly",
+	}
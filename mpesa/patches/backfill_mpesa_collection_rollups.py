@@ -0,0 +1,22 @@
+import frappe
+
+from mpesa.mpesa.rollup import rebuild_rollups
+
+
+def execute():
+	# Rollup buckets are keyed on the payment's own company, so copy it from the
+	# linked invoice for payments created before the column existed
+	frappe.db.sql(
+		"""
+		update `tabMpesa Payment` p
+		left join `tabPOS Invoice` pi on pi.name = p.pos_invoice
+		left join `tabSales Invoice` si on si.name = p.sales_invoice
+		set p.company = coalesce(pi.company, si.company)
+		where coalesce(p.company, '') = ''
+			and coalesce(pi.company, si.company) is not null
+		"""
+	)
+
+	first_payment = frappe.db.get_value("Mpesa Payment", {}, "min(creation)")
+	if first_payment:
+		rebuild_rollups(first_payment)
@@ -37,6 +37,9 @@ function create_mpesa_payment_interface(frm) {
             <button class="btn btn-primary btn-sm btn-mpesa-partial">
                 <i class="fa fa-money"></i> Mixed Payment (Cash + M-Pesa)
             </button>
+            <button class="btn btn-info btn-sm btn-mpesa-qr">
+                <i class="fa fa-qrcode"></i> Pay with M-Pesa QR
+            </button>
             <button class="btn btn-warning btn-sm btn-mpesa-status" style="display: none;">
                 <i class="fa fa-clock-o"></i> Check Payment Status
             </button>
@@ -65,6 +68,12 @@ function setup_mpesa_event_listeners(frm, mpesaSection) {
         show_mixed_payment_dialog(frm);
     });
 
+    // Dynamic QR payment
+    mpesaSection.querySelector('.btn-mpesa-qr').addEventListener('click', function() {
+        // Dynamic QR only takes whole shillings, so charge the rounded total
+        initiate_mpesa_qr_payment(frm, frm.doc.rounded_total || frm.doc.grand_total);
+    });
+
     // Check payment status
     mpesaSection.querySelector('.btn-mpesa-status').addEventListener('click', function() {
         if (checkout_request_id) {
@@ -199,19 +208,7 @@ function initiate_mpesa_payment(frm, amount, payment_type) {
             d.hide();
 
             if (payment_type === 'full') {
-                // Setup full M-Pesa payment
-                frm.doc.payments = frm.doc.payments.filter(p => p.mode_of_payment !== "Cash");
-                const payment_exists = frm.doc.payments.some(p => p.mode_of_payment === "M-Pesa Express");
-                if (!payment_exists) {
-                    frm.add_child('payments', {
-                        mode_of_payment: "M-Pesa Express",
-                        amount: amount,
-                        base_amount: amount,
-                        account: 'M-Pesa Express - TS'
-                    });
-                }
-                frm.set_value("paid_amount", amount);
-                frm.refresh_field("payments");
+                set_full_mpesa_payment(frm, amount);
             }
 
             save_and_initiate_mpesa(frm, values.phone_number, amount, payment_type);
@@ -220,61 +217,60 @@ function initiate_mpesa_payment(frm, amount, payment_type) {
     d.show();
 }
 
-function save_and_initiate_mpesa(frm, phone_number, amount, payment_type) {
-    frappe.dom.freeze(__('Saving POS Invoice...'));
-
-    frm.save().then(() => {
-        verify_pos_invoice_and_initiate(frm, phone_number, amount, payment_type, 0);
-    }).catch(err => {
-        frappe.dom.unfreeze();
-        frappe.show_alert({
-            message: __('Failed to save POS Invoice: ') + (err.message || 'Unknown error'),
-            indicator: 'red'
+function set_full_mpesa_payment(frm, amount) {
+    // Setup full M-Pesa payment
+    frm.doc.payments = frm.doc.payments.filter(p => p.mode_of_payment !== "Cash");
+    const mpesa_payment = frm.doc.payments.find(p => p.mode_of_payment === "M-Pesa Express");
+    if (mpesa_payment) {
+        mpesa_payment.amount = amount;
+        mpesa_payment.base_amount = amount;
+    } else {
+        frm.add_child('payments', {
+            mode_of_payment: "M-Pesa Express",
+            amount: amount,
+            base_amount: amount,
+            account: 'M-Pesa Express - TS'
         });
-        console.error('Save error:', err);
-    });
+    }
+    frm.set_value("paid_amount", amount);
+    frm.refresh_field("payments");
 }
 
-function verify_pos_invoice_and_initiate(frm, phone_number, amount, payment_type, retry_count) {
-    const max_retries = 5;
-    const retry_delay = 1000;
-
-    if (retry_count >= max_retries) {
-        frappe.dom.unfreeze();
-        frappe.show_alert({
-            message: __('Failed to save POS Invoice after multiple attempts. Please try again.'),
-            indicator: 'red'
-        });
-        return;
-    }
+function save_and_initiate_mpesa(frm, phone_number, amount, payment_type) {
+    frappe.dom.freeze(__('Saving POS Invoice and initiating M-Pesa payment...'));
 
+    // Save and STK Push happen in one request; the saved invoice comes back in r.docs
     frappe.call({
-        method: "frappe.client.get_value",
+        method: "mpesa.mpesa.api.save_and_pay",
         args: {
-            doctype: "POS Invoice",
-            filters: { name: frm.doc.name },
-            fieldname: ["name", "docstatus"]
+            doc: frm.doc,
+            phone_number: phone_number,
+            amount: amount
         },
         callback: function(r) {
-            if (r.message && r.message.name) {
-                frappe.dom.unfreeze();
-                frappe.show_alert({
-                    message: __('POS Invoice saved successfully. Initiating M-Pesa payment...'),
-                    indicator: 'blue'
-                });
-                show_enhanced_payment_dialog(frm, phone_number, amount, payment_type);
-            } else {
-                console.log(`Retry ${retry_count + 1}/${max_retries}: POS Invoice ${frm.doc.name} not found`);
-                setTimeout(() => {
-                    verify_pos_invoice_and_initiate(frm, phone_number, amount, payment_type, retry_count + 1);
-                }, retry_delay);
+            frappe.dom.unfreeze();
+            if (!r.message) return;
+
+            frm.refresh();
+            show_enhanced_payment_dialog(frm, phone_number, amount, payment_type);
+
+            // The invoice was saved but the STK Push failed; offer retry or cash
+            if (r.message.error) {
+                update_payment_dialog(`Error: ${r.message.error}`, 'error');
+                update_status_section('Payment initialization failed', 'danger');
+                show_retry_options();
+                return;
             }
+
+            handle_stk_push_response(frm, r.message.stk_response, phone_number, amount, payment_type, 0);
         },
         error: function(err) {
-            console.log(`Retry ${retry_count + 1}/${max_retries}: Error checking POS Invoice:`, err);
-            setTimeout(() => {
-                verify_pos_invoice_and_initiate(frm, phone_number, amount, payment_type, retry_count + 1);
-            }, retry_delay);
+            frappe.dom.unfreeze();
+            frappe.show_alert({
+                message: __('Failed to save POS Invoice or initiate M-Pesa payment'),
+                indicator: 'red'
+            });
+            console.error('Save and pay error:', err);
         }
     });
 }
@@ -325,9 +321,6 @@ function show_enhanced_payment_dialog(frm, phone_number, amount, payment_type) {
     // Update status section in main interface
     update_status_section('Initiating payment...', 'info');
     show_status_section();
-
-    // Initiate STK Push
-    initiate_stk_push_api(frm, phone_number, amount, payment_type);
 }
 
 function setup_payment_dialog_listeners(frm, phone_number, amount, payment_type) {
@@ -356,7 +349,9 @@ function setup_payment_dialog_listeners(frm, phone_number, amount, payment_type)
     });
 }
 
-function initiate_stk_push_api(frm, phone_number, amount, payment_type) {
+function initiate_stk_push_api(frm, phone_number, amount, payment_type, busy_retry_count) {
+    busy_retry_count = busy_retry_count || 0;
+
     frappe.call({
         method: "mpesa.mpesa.api.initiate_stk_push",
         args: {
@@ -365,19 +360,7 @@ function initiate_stk_push_api(frm, phone_number, amount, payment_type) {
             pos_invoice_name: frm.doc.name
         },
         callback: function(r) {
-            if (r.message && r.message.ResponseCode === "0") {
-                checkout_request_id = r.message.CheckoutRequestID;
-                update_payment_dialog('STK Push sent successfully!', 'success');
-                update_status_section('Waiting for customer confirmation...', 'info');
-                start_payment_polling(frm, checkout_request_id, payment_type);
-            } else {
-                const error_msg = r.message && r.message.ResponseDescription
-                    ? r.message.ResponseDescription
-                    : 'STK Push failed';
-                update_payment_dialog(`STK Push failed: ${error_msg}`, 'error');
-                update_status_section('Payment failed', 'danger');
-                show_retry_options();
-            }
+            handle_stk_push_response(frm, r.message, phone_number, amount, payment_type, busy_retry_count);
         },
         error: function(r) {
             console.error('M-Pesa API Error:', r);
@@ -398,14 +381,148 @@ function initiate_stk_push_api(frm, phone_number, amount, payment_type) {
     });
 }
 
-function start_payment_polling(frm, checkout_request_id, payment_type) {
+function handle_stk_push_response(frm, response, phone_number, amount, payment_type, busy_retry_count) {
+    if (response && response.busy) {
+        retry_busy_stk_push(frm, phone_number, amount, payment_type, busy_retry_count, response.retry_after);
+    } else if (response && response.ResponseCode === "0") {
+        checkout_request_id = response.CheckoutRequestID;
+        update_payment_dialog('STK Push sent successfully!', 'success');
+        update_status_section('Waiting for customer confirmation...', 'info');
+        start_payment_polling(frm, checkout_request_id, payment_type);
+    } else {
+        const error_msg = response && response.ResponseDescription
+            ? response.ResponseDescription
+            : 'STK Push failed';
+        update_payment_dialog(`STK Push failed: ${error_msg}`, 'error');
+        update_status_section('Payment failed', 'danger');
+        show_retry_options();
+    }
+}
+
+function retry_busy_stk_push(frm, phone_number, amount, payment_type, busy_retry_count, retry_after) {
+    const max_busy_retries = 5;
+
+    if (busy_retry_count >= max_busy_retries) {
+        update_payment_dialog('M-Pesa is busy - please retry shortly', 'warning');
+        update_status_section('M-Pesa busy', 'warning');
+        show_retry_options();
+        return;
+    }
+
+    // Exponential backoff with full jitter so tills do not retry in lockstep
+    const base_delay = (retry_after || 2) * 1000;
+    const delay = Math.random() * base_delay * Math.pow(2, busy_retry_count);
+
+    update_payment_dialog(`M-Pesa is busy, retrying (${busy_retry_count + 1}/${max_busy_retries})...`, 'warning');
+    setTimeout(() => {
+        initiate_stk_push_api(frm, phone_number, amount, payment_type, busy_retry_count + 1);
+    }, delay);
+}
+
+function initiate_mpesa_qr_payment(frm, amount) {
+    if (!amount || amount === 0) {
+        frappe.show_alert({
+            message: __('Please add items to the cart first.'),
+            indicator: 'red'
+        });
+        return;
+    }
+
+    if (frm.doc.docstatus === 1) {
+        frappe.show_alert({
+            message: __('Invoice is already submitted.'),
+            indicator: 'orange'
+        });
+        return;
+    }
+
+    set_full_mpesa_payment(frm, amount);
+
+    // QR codes reference the saved invoice name, so persist pending changes first
+    const saved = frm.is_new() || frm.is_dirty() ? frm.save() : Promise.resolve();
+    saved.then(() => {
+        frappe.call({
+            method: "mpesa.mpesa.qr.generate_qr_code",
+            args: {
+                pos_invoice_name: frm.doc.name,
+                amount: amount
+            },
+            freeze: true,
+            freeze_message: __('Generating M-Pesa QR code...'),
+            callback: function(r) {
+                if (r.message && r.message.qr_code) {
+                    show_qr_payment_dialog(frm, r.message);
+                }
+            }
+        });
+    }).catch((err) => {
+        frappe.show_alert({
+            message: __('Failed to save POS Invoice before generating the M-Pesa QR code'),
+            indicator: 'red'
+        });
+        console.error('QR save error:', err);
+    });
+}
+
+function show_qr_payment_dialog(frm, qr) {
+    if (current_payment_dialog) {
+        current_payment_dialog.hide();
+    }
+
+    current_payment_dialog = new frappe.ui.Dialog({
+        title: __('Scan to Pay with M-Pesa'),
+        size: 'small',
+        fields: [{
+            fieldtype: 'HTML',
+            fieldname: 'qr_code',
+            options: `
+                <div class="text-center payment-status-container">
+                    <img src="data:image/png;base64,${qr.qr_code}" style="width: 250px; margin-bottom: 15px;">
+                    <div class="payment-loading">
+                        <h4 style="color: #2c5aa0;">Waiting for customer to scan and pay...</h4>
+                        <p style="color: #666;">Amount: KES ${qr.amount.toLocaleString()}</p>
+                    </div>
+                    <div class="payment-actions" style="margin-top: 20px;">
+                        <button class="btn btn-secondary btn-sm btn-switch-cash" style="display: none; margin-right: 10px;">
+                            <i class="fa fa-money"></i> Switch to Cash
+                        </button>
+                        <button class="btn btn-danger btn-sm btn-cancel-payment">
+                            <i class="fa fa-times"></i> Cancel
+                        </button>
+                    </div>
+                </div>
+            `
+        }]
+    });
+
+    current_payment_dialog.show();
+
+    const dialog_wrapper = current_payment_dialog.$wrapper;
+    dialog_wrapper.find('.btn-switch-cash').on('click', function() {
+        switch_to_cash_payment(frm, qr.amount, 'full');
+    });
+    dialog_wrapper.find('.btn-cancel-payment').on('click', function() {
+        cancel_payment_process(frm);
+    });
+
+    update_status_section('Waiting for QR payment...', 'info');
+    show_status_section();
+
+    // Keep polling for as long as the QR can still be paid
+    start_payment_polling(frm, null, 'qr', { name: qr.payment }, qr.expires_in);
+}
+
+function start_payment_polling(frm, checkout_request_id, payment_type, filters, timeout_seconds) {
+    filters = filters || { checkout_request_id: checkout_request_id };
+    timeout_seconds = timeout_seconds || 120;
+
     // Clear any existing polling
     if (payment_polling_interval) {
         clearInterval(payment_polling_interval);
     }
 
     let check_count = 0;
-    const max_checks = 24; // 2 minutes at 5-second intervals
+    const max_checks = Math.ceil(timeout_seconds / 5); // at 5-second intervals
 
     payment_polling_interval = setInterval(() => {
         if (check_count >= max_checks) {
@@ -417,29 +534,29 @@ function start_payment_polling(frm, checkout_request_id, payment_type) {
             return;
         }
 
-        check_payment_status(frm, checkout_request_id, payment_type, check_count);
+        check_payment_status(frm, filters, payment_type, check_count, timeout_seconds);
         check_count++;
     }, 5000);
 }
 
-function check_payment_status(frm, checkout_request_id, payment_type, check_count) {
+function check_payment_status(frm, filters, payment_type, check_count, timeout_seconds) {
     frappe.call({
         method: "frappe.client.get_value",
         args: {
             doctype: "Mpesa Payment",
-            filters: { checkout_request_id: checkout_request_id },
+            filters: filters,
             fieldname: ["status", "receipt_number"]
         },
         callback: function(r) {
             if (r.message && r.message.status === "Completed") {
                 clearInterval(payment_polling_interval);
                 payment_successful(frm, r.message.receipt_number, payment_type);
-            } else if (r.message && r.message.status === "Failed") {
+            } else if (r.message && ["Failed", "Cancelled", "Expired"].includes(r.message.status)) {
                 clearInterval(payment_polling_interval);
                 payment_failed(frm, payment_type);
             } else {
                 // Still waiting - update UI
-                const remaining_time = Math.max(0, 120 - (check_count * 5));
+                const remaining_time = Math.max(0, timeout_seconds - (check_count * 5));
                 update_payment_dialog(`Waiting for customer confirmation... (${remaining_time}s remaining)`, 'info');
             }
         },